@@ -1,11 +1,20 @@
 import streamlit as st
 import google.generativeai as genai
+from google.generativeai import caching
 from google.generativeai.types import GenerationConfig, HarmCategory, HarmBlockThreshold
 import json
 import os
 import time
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import datetime
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import storage
+import ratelimit
+import recall
+import llm_gateway
+import tracing
 
 # ==========================================
 # 0. 설정 및 보안 (Password)
@@ -63,63 +72,65 @@ if "current_profile_key" not in st.session_state:
 # ==========================================
 # API 및 DB 연결
 # ==========================================
+# 리런 단위 호출 추적 (tracing.py). st.stop()/st.rerun()으로 끝난 이전 리런은 여기서 마무리
+tracing.configure(st.secrets["general"].get("TRACE_FILE")) # 지정하면 리런마다 JSONL 한 줄
+tracing.finish(st.session_state.get("trace_run"))
+TRACE_SID = st.session_state.setdefault("trace_sid", os.urandom(6).hex())
+st.session_state["trace_run"] = tracing.start(TRACE_SID)
+
 try:
     genai.configure(api_key=st.secrets["general"]["GOOGLE_API_KEY"])
 except:
     st.error("Secrets 키 오류"); st.stop()
 
 @st.cache_resource
-def init_sheet_connection():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    creds_dict = json.loads(st.secrets["gcp"]["info"], strict=False)
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-    sheet_id = st.secrets["general"]["SHEET_ID"]
-    return client.open_by_key(sheet_id).sheet1
+def init_limiters():
+    # 시트 읽기/쓰기, Gemini 요청 한도. 모든 세션이 같은 버킷을 나눠 씀
+    return ratelimit.default_limiters(st.secrets["general"])
+
+@st.cache_resource
+def init_gateway():
+    # 모델 목록/모델 객체/지연 통계를 모든 세션이 공유
+    return llm_gateway.open_gateway(st.secrets["general"], init_limiters()["gemini"])
+
+GATEWAY = init_gateway()
+
+@st.cache_resource
+def init_storage():
+    # secrets의 general.STORAGE = "sheets"(기본) | "sqlite"
+    return storage.open_backend(st.secrets, limiters=init_limiters())
 
 try:
-    SHEET = init_sheet_connection()
+    STORE = init_storage()
 except Exception as e:
-    st.error(f"구글 시트 연결 실패!\n{e}"); st.stop()
+    st.error(f"저장소 연결 실패!\n{e}"); st.stop()
+DB = None # 이번 리런 동안 읽을 대상 (Main App UI 시작 시 고정)
+
+def rerun():
+    # st.rerun() 전에 대기 중인 쓰기를 저장소에 반영
+    STORE.flush(); tracing.finish(st.session_state.get("trace_run")); st.rerun()
 
 # ==========================================
-# Data Handler (Chunk saving)
+# Data Handler
 # ==========================================
-CHUNK_SIZE = 40000 
-
+# 저장소 오류는 삼키지 않음: 일시적 오류를 빈 값으로 착각하면 다음 저장이 실제 데이터를 덮어씀
 def load_json(folder, filename):
     full_key = f"{folder}/{filename}"
-    try:
-        cell = SHEET.find(full_key, in_column=1)
-        if cell:
-            row_values = SHEET.row_values(cell.row)
-            if len(row_values) > 1:
-                return json.loads("".join(row_values[1:]))
-    except: pass
-    return {}
-
-def save_json(folder, filename, data):
-    full_key = f"{folder}/{filename}"
-    try:
-        data_str = json.dumps(data, ensure_ascii=False)
-        chunks = [data_str[i:i+CHUNK_SIZE] for i in range(0, len(data_str), CHUNK_SIZE)]
-        row_data = [full_key] + chunks
-        cell = SHEET.find(full_key, in_column=1)
-        if cell:
-            if len(row_data) > SHEET.col_count: SHEET.resize(cols=len(row_data) + 5)
-            SHEET.update(range_name=f"A{cell.row}", values=[row_data])
-        else:
-            SHEET.append_row(row_data)
-    except Exception as e:
-        print(f"Save Error: {e}")
+    with tracing.span("load_json", key=full_key) as sp:
+        raw = DB.get(full_key)
+        sp.set(bytes=tracing.size_of(raw))
+    if not raw: return {}
+    try: return json.loads(raw)
+    except ValueError as e: raise storage.StorageError(f"{full_key} 데이터를 읽을 수 없음: {e}")
+
+def save_json(folder, filename, data, expect=None):
+    # expect: 읽을 때의 버전(DB.version). 그 사이 다른 곳에서 저장했으면 storage.VersionConflict
+    raw = json.dumps(data, ensure_ascii=False)
+    with tracing.span("save_json", key=f"{folder}/{filename}", bytes=tracing.size_of(raw)):
+        return STORE.put(f"{folder}/{filename}", raw, DB, expect)
 
 def delete_json(folder, filename):
-    full_key = f"{folder}/{filename}"
-    try:
-        cell = SHEET.find(full_key, in_column=1)
-        if cell: SHEET.delete_rows(cell.row); return True
-    except: pass
-    return False
+    with tracing.span("delete_json", key=f"{folder}/{filename}"): return STORE.delete(f"{folder}/{filename}", DB)
 
 # ==========================================
 # [NEW] Config Manager (프로필별 분리)
@@ -168,26 +179,188 @@ def delete_session(char_id, simple_name):
     if simple_name in meta["sessions"]:
         meta["sessions"].remove(simple_name)
         real_filename = f"{char_id}__{simple_name}.json"
-        delete_json("history", real_filename)
+        delete_history(real_filename)
         if not meta["sessions"]: meta["sessions"] = ["Default"]
         save_session_meta(char_id, meta)
         return True
     return False
 
-def get_all_data_optimized():
-    try: return SHEET.get_all_values() 
-    except: return []
+# ==========================================
+# Chat History (페이지 단위 저장)
+# ==========================================
+# history/{파일}            : 매니페스트 {"v": 2, "next_id": n, "pages": [{"id", "n"}, ...]}
+# history_pages/{파일}#{id} : 메시지 최대 HISTORY_PAGE_SIZE개
+# 추가는 마지막 페이지만, 수정/삭제는 해당 페이지만 다시 씀
+# 각 행은 읽을 때의 버전을 기억했다가 그 버전일 때만 덮어씀. 아니면 h["stale"] → 다음 리런에 다시 불러옴
+HISTORY_PAGE_SIZE = 50
+HISTORY_OPEN_PAGES = 2 # 대화방을 열 때 불러올 마지막 페이지 수
+CHAT_WINDOW = 30 # 화면에 그릴 최근 메시지 수 ('이전 대화 더 보기'마다 이만큼 늘어남)
+
+def _page_name(fname, pid): return f"{fname}#{pid}"
+
+def _save_checked(h, folder, name, data, expect):
+    if h.get("stale"): return expect # 이미 어긋난 상태에서 나머지만 쓰면 매니페스트와 페이지가 엇갈림
+    try: return save_json(folder, name, data, expect)
+    except storage.VersionConflict as e:
+        print(f"History Conflict: {e}")
+        h["stale"] = True; return expect
+
+def _save_manifest(h):
+    h["ver"] = _save_checked(h, "history", h["file"], {"v": 2, "next_id": h["next_id"], "pages": [{"id": p["id"], "n": p["n"]} for p in h["pages"]]}, h.get("ver"))
+
+def _save_page(h, p):
+    p["ver"] = _save_checked(h, "history_pages", _page_name(h["file"], p["id"]), p["msgs"], p.get("ver"))
+    if not h.get("stale"): _save_page_index(h, p)
+
+def _load_page(h, p):
+    if p["msgs"] is None:
+        name = _page_name(h["file"], p["id"])
+        p["msgs"] = load_json("history_pages", name) or []
+        p["n"], p["ver"] = len(p["msgs"]), DB.version(f"history_pages/{name}")
+
+def _new_page(h, msgs):
+    p = {"id": h["next_id"], "n": len(msgs), "msgs": msgs, "ver": 0}
+    h["next_id"] += 1; h["pages"].append(p)
+    return p
+
+def open_history(fname):
+    data = load_json("history", fname)
+    h = {"file": fname, "pages": [], "next_id": 0, "ver": DB.version(f"history/{fname}"), "opened_at": time.time()}
+    if isinstance(data, list): # 예전 단일 행 형식 → 페이지로 옮김
+        for i in range(0, len(data), HISTORY_PAGE_SIZE): _save_page(h, _new_page(h, data[i:i+HISTORY_PAGE_SIZE]))
+        _save_manifest(h)
+    elif data:
+        h["next_id"] = data.get("next_id", 0)
+        h["pages"] = [{"id": p["id"], "n": p["n"], "msgs": None} for p in data.get("pages", [])]
+        for p in h["pages"][-HISTORY_OPEN_PAGES:]: _load_page(h, p)
+    return h
+
+def _loaded_from(h):
+    # 불러온 페이지는 항상 뒤쪽부터 연속
+    i = len(h["pages"])
+    while i > 0 and h["pages"][i-1]["msgs"] is not None: i -= 1
+    return i
+
+def history_len(h): return sum(p["n"] for p in h["pages"])
+
+def read_messages(h, start, end):
+    # [start, end) 메시지를 화면 상태는 건드리지 않고 읽음 (안 불러온 페이지는 스냅샷에서)
+    out, pos = [], 0
+    for p in h["pages"]:
+        if pos + p["n"] > start and pos < end:
+            msgs = p["msgs"] if p["msgs"] is not None else (load_json("history_pages", _page_name(h["file"], p["id"])) or [])
+            out += msgs[max(start - pos, 0):end - pos]
+        pos += p["n"]
+    return out
+
+def history_messages(h):
+    # (첫 메시지의 절대 인덱스, 불러온 메시지 목록)
+    i = _loaded_from(h)
+    return sum(p["n"] for p in h["pages"][:i]), [m for p in h["pages"][i:] for m in p["msgs"]]
+
+def load_older_history(h):
+    i = _loaded_from(h)
+    if i: _load_page(h, h["pages"][i-1])
+
+def _locate(h, idx):
+    for p in h["pages"]:
+        if idx < p["n"]: _load_page(h, p); return p, idx
+        idx -= p["n"]
+    raise IndexError(idx)
+
+def append_message(h, msg):
+    tail = h["pages"][-1] if h["pages"] else None
+    if tail is None or tail["n"] >= HISTORY_PAGE_SIZE: tail = _new_page(h, [])
+    _load_page(h, tail)
+    tail["msgs"].append(msg); tail["n"] = len(tail["msgs"])
+    _save_page(h, tail); _save_manifest(h)
+
+def edit_message(h, idx, content):
+    p, off = _locate(h, idx)
+    p["msgs"][off]["content"] = content
+    _save_page(h, p)
+
+def delete_message(h, idx):
+    p, off = _locate(h, idx)
+    del p["msgs"][off]; p["n"] -= 1
+    if p["n"]: _save_page(h, p)
+    else:
+        h["pages"].remove(p); _delete_pages(h["file"], [p["id"]])
+    _save_manifest(h)
+
+def clear_history(h):
+    _delete_pages(h["file"], [p["id"] for p in h["pages"]])
+    h["pages"] = []
+    _save_manifest(h)
+
+def delete_history(fname):
+    data = load_json("history", fname)
+    if isinstance(data, dict): _delete_pages(fname, [p["id"] for p in data.get("pages", [])])
+    delete_json("history", fname)
+
+def _delete_pages(fname, pids):
+    # 페이지와 그 색인을 저장소마다 한 번에 지움 (시트면 행 삭제 요청 하나씩)
+    if not pids: return
+    names = [_page_name(fname, pid) for pid in pids]
+    with tracing.span("delete_pages", pages=len(names)): STORE.delete_many([f"history_pages/{n}" for n in names], DB)
+    with tracing.span("delete_index", pages=len(names)): init_index_store().delete_many([f"history_index/{n}" for n in names])
+
+# ==========================================
+# Recall (오래된 대화 회상)
+# ==========================================
+# history_index/{파일}#{id} : 같은 id 페이지 메시지들의 벡터 {"n", "q"} (recall.py). 페이지를 저장할 때 같이 갱신
+# 시트 저장소면 별도 워크시트(RECALL_WORKSHEET)에 둠 → 앱 시작 때 받는 본 시트 스냅샷에 안 들어가고 처음 회상할 때만 받음
+# (예전에 본 시트에 쓴 색인은 python storage.py move history_index/ --worksheet history_index 로 옮김)
+# 요약/예산 밖으로 밀려난 메시지 중 마지막 user 턴과 비슷한 것을 최근 대화 앞에 붙임
+RECALL_TOP_K = 4
+RECALL_MIN_SCORE = 0.12 # 해싱 벡터라 무관한 문장끼리도 0.1 안팎은 나옴
+RECALL_MAX_CHARS = 600  # 회상 메시지는 앞부분만 보냄
+RECALL_WORKSHEET = "history_index"
+
+@st.cache_resource
+def init_index_store():
+    # 처음 쓰거나 회상할 때 열림. SQLite는 읽는 만큼만 가져오므로 본 저장소를 그대로 씀
+    if st.secrets["general"].get("STORAGE", "sheets") != "sheets": return init_storage()
+    be = storage.open_backend(st.secrets, "sheets", limiters=init_limiters(), worksheet=RECALL_WORKSHEET)
+    be.load_index() # 행 번호/버전만 (A:B). 값은 회상할 때 그 세션 페이지의 행만 fetch()로
+    return be
+
+def _write_index(name, idx):
+    with tracing.span("save_index", key=name): init_index_store().put(f"history_index/{name}", json.dumps(idx))
+
+def _save_page_index(h, p):
+    _write_index(_page_name(h["file"], p["id"]), {"n": p["n"], "q": recall.encode_page([m["content"] for m in p["msgs"]])})
+
+def recall_messages(h, query, before):
+    # [0, before) 메시지 중 query와 비슷한 것 → [(절대 인덱스, 메시지)] 시간순
+    if not query.strip() or before <= 0: return []
+    names, pos = [], 0
+    for p in h["pages"]:
+        if pos >= before: break
+        names.append(f"history_index/{_page_name(h['file'], p['id'])}"); pos += p["n"]
+    with tracing.span("load_index", pages=len(names)): rows = init_index_store().fetch(names)
+    pages, pos = [], 0
+    for p in h["pages"]:
+        if pos >= before: break
+        name = _page_name(h["file"], p["id"])
+        try: idx = json.loads(rows.get(f"history_index/{name}") or "{}")
+        except ValueError: idx = {}
+        mat = recall.decode_page(idx.get("q", ""), p["n"]) if idx.get("n") == p["n"] else None
+        if mat is None: # 색인 전에 쓴 대화 → 이 페이지만 만들어 저장
+            texts = [m["content"] for m in (p["msgs"] if p["msgs"] is not None else read_messages(h, pos, pos + p["n"]))]
+            q = recall.encode_page((texts + [""] * p["n"])[:p["n"]])
+            _write_index(name, {"n": p["n"], "q": q})
+            mat = recall.decode_page(q, p["n"])
+        pages.append(mat); pos += p["n"]
+    hits = sorted(i for i, _ in recall.search(query, pages, RECALL_TOP_K, RECALL_MIN_SCORE, before))
+    return [(i, m) for i in hits for m in read_messages(h, i, i + 1)]
 
 def load_characters():
-    rows = get_all_data_optimized()
     db = {}
-    for r in rows:
-        if not r: continue
-        fname = r[0]
-        if fname.startswith('characters/') and fname.endswith('.json'):
+    for fname, full in DB.scan('characters/').items():
+        if fname.endswith('.json'):
             cid = fname.split('/')[-1].replace('.json', '')
             try:
-                full = "".join(r[1:]) 
                 if not full: continue
                 data = json.loads(full)
                 for k in ["name","description","system_prompt","first_message"]: data.setdefault(k,"")
@@ -197,15 +370,11 @@ def load_characters():
     return db
 
 def load_users():
-    rows = get_all_data_optimized()
     db = {}
-    for r in rows:
-        if not r: continue
-        fname = r[0]
-        if fname.startswith('users/') and fname.endswith('.json'):
+    for fname, full in DB.scan('users/').items():
+        if fname.endswith('.json'):
             uid = fname.split('/')[-1].replace('.json', '')
             try: 
-                full = "".join(r[1:])
                 db[uid] = json.loads(full)
             except: pass
     if not db:
@@ -220,26 +389,138 @@ def load_memory(char_id):
 def load_user_note(char_id): return load_json("usernotes", f"{char_id}.json").get("content", "")
 def save_user_note(char_id, content): save_json("usernotes", f"{char_id}.json", {"content": content})
 
+def _sha1(text): return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+# ==========================================
+# Lorebook Matcher (태그 일괄 매칭)
+# ==========================================
+LORE_MAX_ENTRIES = 5     # 한 번에 넣을 로어북 수 (캐릭터의 "lore_max"로 덮어쓸 수 있음)
+LORE_SCAN_MESSAGES = 20  # 태그를 찾을 최근 메시지 수
+LORE_MATCHERS_MAX = 64
+
+class LoreMatcher:
+    """로어북 태그 전체를 Aho–Corasick 오토마톤 하나로 컴파일. 본문은 한 번만 훑음"""
+    def __init__(self, lorebooks):
+        self.contents = [b.get("content", "") for b in lorebooks]
+        self.goto, self.fail, self.out = [{}], [0], [[]]
+        for i, b in enumerate(lorebooks):
+            for tag in {t.strip().lower() for t in b.get("tags", "").split(",") if t.strip()}:
+                node = 0
+                for ch in tag:
+                    if ch not in self.goto[node]:
+                        self.goto[node][ch] = len(self.goto)
+                        self.goto.append({}); self.fail.append(0); self.out.append([])
+                    node = self.goto[node][ch]
+                self.out[node].append(i)
+        # 실패 링크 (BFS). 더 얕은 노드의 출력은 미리 합쳐 둠
+        q = deque(self.goto[0].values())
+        while q:
+            node = q.popleft()
+            for ch, nxt in self.goto[node].items():
+                q.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]: f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + [i for i in self.out[self.fail[nxt]] if i not in self.out[nxt]] # 한 책의 태그끼리 접미사로 겹쳐도 위치당 1회
+
+    def match(self, text, cap):
+        # 적중 횟수 많은 순, 같으면 더 최근(뒤쪽)에 나온 순
+        hits, last, node = {}, {}, 0
+        for pos, ch in enumerate(text.lower()):
+            while node and ch not in self.goto[node]: node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for i in self.out[node]:
+                hits[i] = hits.get(i, 0) + 1; last[i] = pos
+        ranked = sorted(hits, key=lambda i: (-hits[i], -last[i]))
+        return [self.contents[i] for i in ranked[:cap]]
+
+@st.cache_resource
+def init_lore_matchers():
+    return {} # 로어북 내용 해시 → LoreMatcher (캐릭터를 저장해 내용이 바뀌면 새로 컴파일)
+
+LORE_MATCHERS = init_lore_matchers()
+
+def get_lore_matcher(lorebooks):
+    key = _sha1(json.dumps(lorebooks, ensure_ascii=False, sort_keys=True))
+    m = LORE_MATCHERS.get(key)
+    if m is None:
+        if len(LORE_MATCHERS) >= LORE_MATCHERS_MAX: LORE_MATCHERS.clear()
+        m = LORE_MATCHERS[key] = LoreMatcher(lorebooks)
+    return m
+
 # LLM Functions
-def trigger_lorebooks(text, lorebooks):
-    act = []
-    text = text.lower()
-    for b in lorebooks:
-        tags = [t.strip().lower() for t in b.get("tags", "").split(",") if t.strip()]
-        for tag in tags:
-            if tag in text: act.append(b.get("content", "")); break
-    return "\n[Active Lorebook]\n" + "\n".join(act[:5]) + "\n" if act else ""
-
-def generate_response(chat_model_id, c_char, c_user, mem, history, user_note):
-    chat_model = genai.GenerativeModel(chat_model_id)
-    gen_config = GenerationConfig(temperature=1.0, top_p=0.95, max_output_tokens=8192)
-    safety = {HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE, HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE, HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE, HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE}
-    
-    recent = history[-1]['content'] if history and history[-1]['role'] == 'user' else ""
-    ctx = "\n".join([m['content'] for m in history[-5:]])
-    active_lore = trigger_lorebooks(ctx + recent, c_char.get("lorebooks", []))
-    
-    sys = f"""
+def trigger_lorebooks(text, lorebooks, cap=LORE_MAX_ENTRIES):
+    act = get_lore_matcher(lorebooks).match(text, cap) if lorebooks else []
+    return "\n[Active Lorebook]\n" + "\n".join(act) + "\n" if act else ""
+
+def _chunk_text(chunk):
+    try: return chunk.text
+    except ValueError: return "" # 안전 필터 등으로 텍스트 없는 조각
+
+# ==========================================
+# Prompt Builder (토큰 예산 + 고정 prefix 캐시)
+# ==========================================
+PROMPT_TOKEN_BUDGET = int(st.secrets["general"].get("PROMPT_TOKEN_BUDGET", 30000)) # 입력 프롬프트 최대 토큰
+CONTEXT_CACHE_MIN_TOKENS = 32768 # Gemini 1.5 컨텍스트 캐시 최소 크기. 이보다 짧은 prefix는 system_instruction으로만
+CONTEXT_CACHE_TTL_MIN = 30
+TOKEN_CACHE_MAX = 50000
+PROMPT_RECOUNT_MAX = 2 # 완성된 suffix를 실제로 세는 최대 횟수 (넘치면 덜어내고 한 번 더)
+PROMPT_SUFFIX_MIN_TOKENS = 4000 # prefix가 예산을 거의 다 써도 최근 대화에 남겨 둘 최소 토큰
+
+@st.cache_resource
+def init_token_cache():
+    return {} # (model_id, sha1) → 토큰 수
+
+@st.cache_resource
+def init_context_caches():
+    return {} # (model_id, prefix sha1) → (GenerativeModel, 만료 시각)
+
+TOKEN_CACHE = init_token_cache()
+CONTEXT_CACHES = init_context_caches()
+
+def estimate_tokens(text):
+    # API 없이 넉넉한 대략치: 영문/숫자는 4자당 1, 한글 등은 글자당 1
+    n_ascii = len(text.encode("ascii", "ignore"))
+    return len(text) - n_ascii + n_ascii // 4 + 1
+
+def count_tokens(model_id, text):
+    key = (model_id, _sha1(text))
+    n = TOKEN_CACHE.get(key)
+    if n is None:
+        try: n = GATEWAY.count_tokens(model_id, text)
+        except: n = estimate_tokens(text) # 오류 시 대략치. 같은 글로 제한시간을 또 기다리지 않도록 이것도 캐시
+        if len(TOKEN_CACHE) > TOKEN_CACHE_MAX: TOKEN_CACHE.clear()
+        TOKEN_CACHE[key] = n
+    return n
+
+def _cache_model_id(model_id):
+    # 컨텍스트 캐시는 버전 붙은 모델(…-001)만 받음 → 목록에서 가장 최신 버전으로. 없으면 None (캐시 안 함)
+    if model_id.rsplit("-", 1)[-1].isdigit(): return model_id
+    try: found = [m for m in GATEWAY.models() if m.startswith(model_id + "-") and m[len(model_id) + 1:].isdigit()]
+    except Exception: return None
+    return max(found) if found else None
+
+def get_chat_model(model_id, prefix):
+    # 고정 prefix는 system_instruction으로. 충분히 길면 컨텍스트 캐시로 만들어 여러 턴이 재사용
+    key = (model_id, _sha1(prefix))
+    ent = CONTEXT_CACHES.get(key)
+    if ent and ent[1] > time.time(): return ent[0]
+    model = None
+    cache_id = _cache_model_id(model_id) if count_tokens(model_id, prefix) >= CONTEXT_CACHE_MIN_TOKENS else None
+    if cache_id:
+        try:
+            cc = caching.CachedContent.create(model=cache_id, system_instruction=prefix, ttl=datetime.timedelta(minutes=CONTEXT_CACHE_TTL_MIN))
+            model = genai.GenerativeModel.from_cached_content(cached_content=cc)
+        except Exception as e: print(f"Context Cache Error: {e}")
+    if model is None: model = GATEWAY.model(model_id, prefix)
+    now = time.time()
+    for k in [k for k, v in CONTEXT_CACHES.items() if v[1] <= now]: CONTEXT_CACHES.pop(k, None)
+    CONTEXT_CACHES[key] = (model, now + CONTEXT_CACHE_TTL_MIN * 60 - 60) # 서버 쪽 만료 1분 전에 새로 만듦
+    return model
+
+def build_prompt(model_id, c_char, c_user, mem, history, user_note, recalled=(), budget=PROMPT_TOKEN_BUDGET):
+    # (prefix, suffix). prefix = 캐릭터/페르소나/기억 (턴 간 고정), suffix = 로어북 + 회상 + 예산 안의 최근 대화
+    prefix = f"""
     [Roleplay]
     Target: {c_char['name']} ({c_char['description']})
     System: {c_char['system_prompt']}
@@ -247,18 +528,174 @@ def generate_response(chat_model_id, c_char, c_user, mem, history, user_note):
     User Note: {user_note}
     Memory: {mem.get('summary')}
     Recent: {mem.get('recent_event')}
-    {active_lore}
     """
-    full = f"System: {sys}\n" + "\n".join([f"{m['role']}: {m['content']}" for m in history])
-    return chat_model.generate_content(full, generation_config=gen_config, safety_settings=safety).text
+    ctx = "\n".join([m['content'] for m in history[-LORE_SCAN_MESSAGES:]])
+    head = trigger_lorebooks(ctx, c_char.get("lorebooks", []), c_char.get("lore_max", LORE_MAX_ENTRIES))
+    if recalled: head += "\n[Recalled Earlier Turns]\n" + "\n".join(f"{m['role']}: {m['content'][:RECALL_MAX_CHARS]}" for _, m in recalled) + "\n"
+    if history and history[-1].get("partial"): head += "(마지막 assistant 답변이 중간에 끊겼음. 반복하지 말고 끊긴 지점부터 바로 이어서 작성)\n"
+
+    # 최신 메시지부터 예산이 찰 때까지 로컬 대략치로 고르고 (마지막 메시지는 항상 포함),
+    # 실제 토큰은 완성된 suffix로 한 번만 셈. 넘치면 오래된 줄부터 덜어냄
+    # 컨텍스트 캐시로 갈 만큼 긴 prefix(≥ CONTEXT_CACHE_MIN_TOKENS > 예산)는 예산에서 빼지 않고 suffix만 예산으로 셈
+    n_prefix = count_tokens(model_id, prefix)
+    limit = budget if n_prefix >= CONTEXT_CACHE_MIN_TOKENS else max(budget - n_prefix, PROMPT_SUFFIX_MIN_TOKENS)
+    left, lines = limit - estimate_tokens(head), []
+    for m in reversed(history):
+        line = f"{m['role']}: {m['content']}"
+        n = estimate_tokens(line)
+        if lines and n > left: break
+        lines.append(line); left -= n
+    lines.reverse()
+    suffix = head + "\n".join(lines)
+    for _ in range(PROMPT_RECOUNT_MAX):
+        over = count_tokens(model_id, suffix) - limit
+        if over <= 0 or len(lines) <= 1: break
+        while len(lines) > 1 and over > 0: over -= estimate_tokens(lines.pop(0))
+        suffix = head + "\n".join(lines)
+    return prefix, suffix
+
+SAFETY_SETTINGS = {HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE, HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE, HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE, HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE}
+CHAT_CONFIG = GenerationConfig(temperature=1.0, top_p=0.95, max_output_tokens=8192)
+SUMMARY_CONFIG = GenerationConfig(temperature=0.3, response_mime_type="application/json")
+
+def generate_response(chat_model_id, c_char, c_user, mem, history, user_note, stream=False, recalled=()):
+    prefix, suffix = build_prompt(chat_model_id, c_char, c_user, mem, history, user_note, recalled)
+    chat_model = get_chat_model(chat_model_id, prefix)
+    resp = GATEWAY.generate(chat_model, suffix, stream=stream, generation_config=CHAT_CONFIG, safety_settings=SAFETY_SETTINGS)
+    if not stream: return resp.text
+    return (_chunk_text(c) for c in resp)
+
+def stream_reply(hist, chat_model_id, c_char, c_user, mem, user_note):
+    # 받는 대로 말풍선에 그림. 중간에 끊기면 받은 데까지 partial로 저장 → '이어서 받기'가 그 뒤부터 이어감
+    base, msgs = history_messages(hist)
+    if msgs and msgs[-1]["role"] == "assistant" and msgs[-1].get("partial"):
+        msg, idx = msgs[-1], base + len(msgs) - 1
+    else:
+        msg, idx = {"role": "assistant", "content": "", "partial": True}, base + len(msgs)
+        append_message(hist, msg)
+        msgs = msgs + [msg]
+    with st.chat_message("assistant"):
+        box = st.empty()
+        if msg["content"]: box.markdown(msg["content"] + "▌")
+        try:
+            ctx = msgs if msg["content"] else msgs[:-1]
+            start = max(summary_watermark(mem, hist["file"]), base)
+            ctx = ctx[start - base:] # 요약된 앞부분은 Memory로 대체
+            query = next((m["content"] for m in reversed(ctx) if m["role"] == "user"), "")
+            recalled = recall_messages(hist, query, start)
+            for chunk in generate_response(chat_model_id, c_char, c_user, mem, ctx, user_note, stream=True, recalled=recalled):
+                msg["content"] += chunk
+                box.markdown(msg["content"] + "▌")
+            msg.pop("partial", None)
+            box.markdown(msg["content"])
+        finally:
+            if msg["content"]: edit_message(hist, idx, msg["content"])
+            else: delete_message(hist, idx) # 하나도 못 받았으면 user 턴으로 남겨 재시도
+            STORE.flush()
+
+# ==========================================
+# Memory Summarizer (백그라운드 요약)
+# ==========================================
+# memory/{char_id}.json 의 summary/recent_event/location 을 갱신하고
+# covered[{세션 파일}] 에 요약이 덮는 메시지 수(워터마크)를 기록
+SUMMARY_MODEL = "models/gemini-1.5-flash"
+SUMMARY_KEEP_RECENT = 20        # 최근 메시지는 요약하지 않고 원문으로 보냄
+SUMMARY_EVERY = 20              # 요약 안 된 메시지가 이만큼 쌓이면 요약
+SUMMARY_TOKEN_THRESHOLD = 8000  # 또는 토큰이 이만큼 넘으면
+SUMMARY_BATCH_MAX = 80          # 한 번에 요약할 최대 메시지 수
+
+@st.cache_resource
+def init_summarizer():
+    return {"pool": ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary"), "running": set(), "lock": threading.Lock()}
+
+SUMMARIZER = init_summarizer()
+
+def summary_watermark(mem, fname): return mem.get("covered", {}).get(fname, 0)
+
+def shift_summary_watermark(char_id, fname, idx=None):
+    # idx 메시지 삭제 → 워터마크를 한 칸 당김. idx=None이면 대화 초기화 → 0
+    mem = load_json("memory", f"{char_id}.json")
+    cov = mem.get("covered", {})
+    if cov.get(fname) and (idx is None or idx < cov[fname]):
+        cov[fname] = 0 if idx is None else cov[fname] - 1
+        save_json("memory", f"{char_id}.json", mem)
+
+def _summarize_job(char_id, fname, start, end, msgs, sid):
+    with tracing.scope(sid, "summary"): _summarize(char_id, fname, start, end, msgs) # 리런과 따로 집계
+
+def _summarize(char_id, fname, start, end, msgs):
+    try:
+        mem, ver = load_json("memory", f"{char_id}.json"), DB.version(f"memory/{char_id}.json")
+        if summary_watermark(mem, fname) != start: return # 그 사이 다른 곳에서 갱신됨
+        convo = "\n".join([f"{m['role']}: {m['content']}" for m in msgs])
+        prompt = f"""다음은 롤플레이의 기존 기억과 그 뒤에 이어진 대화다.
+기존 요약에 새 대화 내용을 합쳐 JSON으로만 답하라.
+{{"summary": "전체 줄거리 요약 (중요한 사건, 관계 변화, 약속은 유지. 2000자 이내)", "recent_event": "가장 최근 사건 1~2문장", "location": "현재 장소"}}
+
+[기존 요약]
+{mem.get('summary', '')}
+[최근 사건] {mem.get('recent_event', '')}
+[장소] {mem.get('location', '')}
+
+[새 대화]
+{convo}"""
+        resp = GATEWAY.generate(GATEWAY.model(SUMMARY_MODEL), prompt, hedge=False, generation_config=SUMMARY_CONFIG, safety_settings=SAFETY_SETTINGS) # 백그라운드라 헤징 불필요
+        out = json.loads(resp.text)
+        for k in ["summary", "recent_event", "location"]:
+            if out.get(k): mem[k] = out[k]
+        mem.setdefault("covered", {})[fname] = end
+        save_json("memory", f"{char_id}.json", mem, ver) # 요약하는 동안 기억이 수정됐으면 버림 (다음 턴에 다시)
+    except Exception as e: print(f"Summary Error: {e}")
+    finally:
+        with SUMMARIZER["lock"]: SUMMARIZER["running"].discard(char_id)
+
+def maybe_summarize(char_id, h, mem):
+    # 요약 안 된 메시지가 충분히 쌓였으면 워커 스레드에 맡김 (응답 경로를 막지 않음)
+    start = summary_watermark(mem, h["file"])
+    end = min(history_len(h) - SUMMARY_KEEP_RECENT, start + SUMMARY_BATCH_MAX)
+    if end <= start: return
+    msgs = read_messages(h, start, end)
+    if end - start < SUMMARY_EVERY and sum(estimate_tokens(f"{m['role']}: {m['content']}") for m in msgs) < SUMMARY_TOKEN_THRESHOLD: return
+    with SUMMARIZER["lock"]:
+        if char_id in SUMMARIZER["running"]: return # 기억은 캐릭터 단위라 캐릭터당 하나씩
+        SUMMARIZER["running"].add(char_id)
+    SUMMARIZER["pool"].submit(_summarize_job, char_id, h["file"], start, end, msgs, TRACE_SID)
+
+# ==========================================
+# Prefetch (서로 독립적인 네트워크 로드를 동시에. 스냅샷만 읽는 파싱은 그냥 호출)
+# ==========================================
+PREFETCH_TIMEOUT = 30 # 초. 개별 작업은 (함수, 실패 시 값, 제한시간)으로 따로 지정 가능
+PREFETCH_FAILED = object() # 실패 시 값을 안 준 작업의 표시 ("" / {} 같은 빈 결과와 구분)
+
+@st.cache_resource
+def init_executor():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="prefetch")
+
+EXECUTOR = init_executor()
+
+def prefetch(jobs):
+    # {이름: (함수[, 실패/시간초과 시 값[, 제한시간]])} 를 한꺼번에 시작하고 모두 기다림
+    # 실패 시 값이 없는 작업이 실패하면 그 예외를 던짐. 같은 호출을 여기서 다시 하지 않음 (돌고 있는 쪽의 잠금을 또 기다리게 됨)
+    futs = {k: EXECUTOR.submit(tracing.bind(job[0])) for k, job in jobs.items()} # 작업 안의 span도 이번 리런으로
+    start, out, err = time.time(), {}, None
+    for k, f in futs.items():
+        limit = jobs[k][2] if len(jobs[k]) > 2 else PREFETCH_TIMEOUT
+        try: out[k] = f.result(timeout=max(limit - (time.time() - start), 0))
+        except Exception as e:
+            if isinstance(e, FutureTimeout) and not f.done(): e = TimeoutError(f"{k}: {limit}초 안에 끝나지 않음")
+            print(f"Prefetch Error ({k}): {e}")
+            out[k] = jobs[k][1] if len(jobs[k]) > 1 else PREFETCH_FAILED
+            if out[k] is PREFETCH_FAILED: err = err or e
+    if err: raise err
+    return out
 
 # ==========================================
 # Main App UI
 # ==========================================
 try:
-    CHARACTER_DB = load_characters()
-    USER_DB = load_users()
-    current_config = load_config()
+    PRE = prefetch({"db": (STORE.view,), "models": (GATEWAY.models, ["models/gemini-1.5-flash"], 10)})
+    DB, av_models = PRE["db"], PRE["models"]
+    CHARACTER_DB, USER_DB, current_config = load_characters(), load_users(), load_config() # 이미 받은 스냅샷만 읽음
 except Exception as e:
     st.error(f"데이터 로드 실패: {e}"); st.stop()
 
@@ -267,20 +704,32 @@ with st.sidebar:
     col_home, col_txt = st.columns([1, 4])
     if col_home.button("🏠", help="프로필 변경"):
         del st.session_state["current_profile_key"]
-        st.rerun()
+        rerun()
         
     p_name = "나 (Master)" if "master" in CONFIG_FILE else ("친구" if "friend" in CONFIG_FILE else "게스트")
     col_txt.markdown(f"**{p_name}** 접속 중")
+    if STORE.last_error: st.warning(f"⚠️ 저장 지연 (자동 재시도 중): {STORE.last_error}")
+    if STORE.conflicts_since(time.time() - 300): st.caption("⚠️ 최근 다른 곳에서 먼저 저장된 항목이 있어 일부 변경을 덮어쓰지 않았습니다.")
+    if st.secrets["general"].get("TRACE_PANEL", False):
+        with st.expander("⏱️ 성능 추적"):
+            ts = tracing.session_stats(TRACE_SID)
+            if not ts or not ts["last"]: st.caption("아직 끝난 리런이 없습니다.")
+            else:
+                st.caption(f"직전 리런 {ts['last']['ms']:.0f}ms · 이 세션 리런 {ts['runs'].get('rerun', 0)}회 / 평균 {ts['ms'].get('rerun', 0) / max(ts['runs'].get('rerun', 1), 1):.0f}ms")
+                rows = lambda spans: sorted([{"span": k, **{c: round(v, 1) if isinstance(v, float) else v for c, v in t.items()}} for k, t in spans.items()], key=lambda r: -r["ms"])
+                st.dataframe(rows(ts["last"]["spans"]), hide_index=True)
+                st.caption("세션 누적")
+                st.dataframe(rows(ts["spans"]), hide_index=True)
     st.divider()
     
     # 모델 선택
-    try: av_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]; av_models.sort()
-    except: av_models = ["models/gemini-1.5-flash"]
     try: ic = av_models.index(current_config.get("chat_model"))
     except: ic = 0
     chat_model_id = st.selectbox("모델", av_models, index=ic)
     if chat_model_id != current_config.get("chat_model"):
-        update_config("chat_model", chat_model_id); st.rerun()
+        update_config("chat_model", chat_model_id); rerun()
+    lat = GATEWAY.stats().get(f"{chat_model_id} (stream)")
+    if lat and lat["calls"]: st.caption(f"첫 응답 p50 {lat['p50']}s · p95 {lat['p95']}s ({lat['calls']}회, 헤징 {lat['hedged']}회 / 오류 {lat['errors']}회)")
         
     st.divider()
 
@@ -292,7 +741,7 @@ with st.sidebar:
         try: default_cid_idx = char_options.index(saved_cid)
         except: default_cid_idx = 0
         sel_cid = st.selectbox("🤖 캐릭터", char_options, index=default_cid_idx, format_func=lambda x: CHARACTER_DB[x]["name"])
-        if sel_cid != current_config.get("last_char_id", ""): update_config("last_char_id", sel_cid); st.rerun()  
+        if sel_cid != current_config.get("last_char_id", ""): update_config("last_char_id", sel_cid); rerun()  
         curr_char = CHARACTER_DB[sel_cid]
     else:
         curr_char = None; sel_cid = None
@@ -315,19 +764,19 @@ with st.sidebar:
             
             if sel_session != last_s:
                 update_config(last_s_key, sel_session) # 프로필 config에 저장
-                st.rerun()
+                rerun()
             current_session = sel_session
             
             new_s = st.text_input("새 대화방 이름", key="n_s")
             if st.button("추가"):
                 if new_s and create_new_session(sel_cid, new_s): 
-                    update_config(last_s_key, new_s); st.rerun()
+                    update_config(last_s_key, new_s); rerun()
             
-            if len(s_list)>1 and st.button("삭제", type="primary"):
+            if len(s_list)>1 and st.button("삭제", type="primary", key="del_sess"):
                 delete_session(sel_cid, current_session)
                 # 삭제 후 첫번째로 이동
                 update_config(last_s_key, s_list[0] if s_list[0]!=current_session else s_list[1])
-                st.rerun()
+                rerun()
 
     # 3. 유저 페르소나
     user_options = list(USER_DB.keys())
@@ -337,14 +786,14 @@ with st.sidebar:
         try: ui = user_options.index(saved_uid)
         except: ui = 0
         sel_uid = st.selectbox("👤 페르소나", user_options, index=ui, format_func=lambda x: USER_DB[x]["name"])
-        if sel_uid != current_config.get("last_user_id", ""): update_config("last_user_id", sel_uid); st.rerun()
+        if sel_uid != current_config.get("last_user_id", ""): update_config("last_user_id", sel_uid); rerun()
         curr_user = USER_DB[sel_uid]
     else:
         curr_user = {"name": "User", "gender": "?", "age": "?", "profile": "New Traveler"}
         sel_uid = "default"
         
     st.divider()
-    if st.button("🔄 새로고침"): st.rerun()
+    if st.button("🔄 새로고침"): rerun()
 
 # 탭 구성
 tab1, tab2, tab3 = st.tabs([f"💬 대화 ({current_session})", "🧠 기억", "✏️ 스튜디오"])
@@ -353,70 +802,76 @@ if sel_cid:
     # 세션별 파일 로드
     real_filename = f"{sel_cid}__{current_session}.json"
     sess_key = f"hist_{sel_cid}_{current_session}"
+    h_old = st.session_state.get(sess_key)
+    if h_old and (h_old.get("stale") or any(k == f"history/{real_filename}" or k.startswith(f"history_pages/{real_filename}#") for k in STORE.conflicts_since(h_old["opened_at"]))):
+        del st.session_state[sess_key] # 다른 기기/탭에서 먼저 바뀜 → 시트의 내용으로 다시 불러옴
+        st.warning("⚠️ 다른 곳에서 이 대화가 먼저 바뀌어 다시 불러왔습니다. 마지막 변경은 저장되지 않았을 수 있습니다.")
     
-    if sess_key not in st.session_state:
-        hf = load_json("history", real_filename)
-        if not hf and curr_char.get("first_message"):
-            hf = [{"role": "assistant", "content": curr_char["first_message"]}]
-            save_json("history", real_filename, hf)
-        st.session_state[sess_key] = hf if hf else []
-    
-    mem_data = load_memory(sel_cid)
-    u_note = load_user_note(sel_cid)
+    try:
+        if sess_key not in st.session_state:
+            hist = open_history(real_filename) # 스냅샷에서 (예전 형식이면 여기서 한 번만 옮김)
+            if not history_len(hist) and curr_char.get("first_message"):
+                append_message(hist, {"role": "assistant", "content": curr_char["first_message"]})
+            st.session_state[sess_key] = hist
+        mem_data, u_note = load_memory(sel_cid), load_user_note(sel_cid)
+    except Exception as e:
+        st.error(f"대화 로드 실패 (저장하지 않고 멈춤): {e}"); st.stop()
+    hist = st.session_state[sess_key]
+    maybe_summarize(sel_cid, hist, mem_data)
 
     with tab1:
-        # 메시지 렌더링
-        h_len = len(st.session_state[sess_key])
-        for idx, m in enumerate(st.session_state[sess_key]):
+        # 메시지 렌더링 - 최근 win개만 그림 (idx는 대화 전체 기준 절대 인덱스)
+        win = st.session_state.get(f"win_{sess_key}", CHAT_WINDOW)
+        h_base, h_msgs = history_messages(hist)
+        while len(h_msgs) < win and h_base: # 창이 불러온 범위를 넘으면 이전 페이지를 더 불러옴
+            load_older_history(hist); h_base, h_msgs = history_messages(hist)
+        h_len = h_base + len(h_msgs)
+        w_start = max(len(h_msgs) - win, 0)
+        if h_base + w_start and st.button(f"⬆️ 이전 대화 더 보기 ({h_base + w_start})"):
+            st.session_state[f"win_{sess_key}"] = win + CHAT_WINDOW; rerun()
+        for idx, m in enumerate(h_msgs[w_start:], start=h_base + w_start):
             with st.chat_message(m["role"]):
                 # 수정 모드
                 if st.session_state.get(f"em_{sess_key}") == idx:
                     nw = st.text_area("수정", m["content"], key=f"t_{idx}")
                     c1, c2 = st.columns([1,4])
                     if c1.button("저장", key=f"s_{idx}"):
-                        st.session_state[sess_key][idx]["content"] = nw
-                        save_json("history", real_filename, st.session_state[sess_key])
+                        edit_message(hist, idx, nw)
                         st.session_state[f"em_{sess_key}"] = -1
-                        st.rerun()
+                        rerun()
                     if c2.button("취소", key=f"c_{idx}"):
                         st.session_state[f"em_{sess_key}"] = -1
-                        st.rerun()
+                        rerun()
                 # 일반 모드
                 else:
                     st.markdown(m["content"])
                     with st.popover("⋮"):
                         if st.button("✏️ 수정", key=f"e_{idx}", use_container_width=True):
-                            st.session_state[f"em_{sess_key}"] = idx; st.rerun()
+                            st.session_state[f"em_{sess_key}"] = idx; rerun()
                         if st.button("🗑️ 삭제", key=f"d_{idx}", use_container_width=True):
-                            del st.session_state[sess_key][idx]
-                            save_json("history", real_filename, st.session_state[sess_key])
-                            st.rerun()
+                            delete_message(hist, idx); shift_summary_watermark(sel_cid, real_filename, idx)
+                            rerun()
                         # 마지막 봇 재생성
                         if m["role"] == "assistant" and idx == h_len - 1:
                             if st.button("🔄 재생성", key=f"r_{idx}", use_container_width=True):
-                                del st.session_state[sess_key][idx]
-                                with st.spinner("..."):
-                                    r = generate_response(chat_model_id, curr_char, curr_user, mem_data, st.session_state[sess_key], u_note)
-                                    st.session_state[sess_key].append({"role":"assistant", "content":r})
-                                    save_json("history", real_filename, st.session_state[sess_key])
-                                    st.rerun()
+                                delete_message(hist, idx)
+                                st.session_state[f"regen_{sess_key}"] = True; rerun()
+
+        # 재생성: 팝오버 밖(목록 끝)에서 스트리밍
+        if st.session_state.pop(f"regen_{sess_key}", False):
+            stream_reply(hist, chat_model_id, curr_char, curr_user, mem_data, u_note); rerun()
         
-        # 끊김 방지 (Retry)
-        if st.session_state[sess_key] and st.session_state[sess_key][-1]["role"] == "user":
+        # 끊김 방지 (Retry) - user 턴에서 멈췄거나 답변이 중간에 끊긴 경우
+        elif h_msgs and (h_msgs[-1]["role"] == "user" or h_msgs[-1].get("partial")):
             if st.button("🔄 답변 이어서 받기"):
-                with st.spinner("..."):
-                    r = generate_response(chat_model_id, curr_char, curr_user, mem_data, st.session_state[sess_key], u_note)
-                    st.session_state[sess_key].append({"role":"assistant", "content":r})
-                    save_json("history", real_filename, st.session_state[sess_key]); st.rerun()
+                stream_reply(hist, chat_model_id, curr_char, curr_user, mem_data, u_note); rerun()
 
         # 입력
         if p := st.chat_input("메시지..."):
-            st.session_state[sess_key].append({"role":"user", "content":p})
-            save_json("history", real_filename, st.session_state[sess_key])
+            append_message(hist, {"role":"user", "content":p})
+            with st.chat_message("user"): st.markdown(p)
             try:
-                r = generate_response(chat_model_id, curr_char, curr_user, mem_data, st.session_state[sess_key], u_note)
-                st.session_state[sess_key].append({"role":"assistant", "content":r})
-                save_json("history", real_filename, st.session_state[sess_key]); st.rerun()
+                stream_reply(hist, chat_model_id, curr_char, curr_user, mem_data, u_note); rerun()
             except Exception as e: st.error(f"Error: {e}")
 
     with tab2:
@@ -424,8 +879,7 @@ if sel_cid:
         st.text_area("노트", value=u_note, key="un")
         if st.button("노트 저장"): save_user_note(sel_cid, st.session_state["un"]); st.success("OK")
         if st.button("대화만 초기화"):
-            st.session_state[sess_key] = []
-            save_json("history", real_filename, []); st.rerun()
+            clear_history(hist); shift_summary_watermark(sel_cid, real_filename); rerun()
 
     with tab3:
         # 스튜디오 (캐릭터/페르소나)
@@ -448,9 +902,10 @@ if sel_cid:
             if st.button("캐릭터 저장"):
                 if ncid:
                     save_json("characters", f"{ncid}.json", {"name":ncnm, "description":ncds, "first_message":nmsg, "system_prompt":nsys, "lorebooks":[]})
-                    st.success("저장됨"); time.sleep(0.5); st.rerun()
-            if m_c=="수정" and st.button("삭제", type="primary"):
-                 delete_json("characters", f"{sel_cid}.json"); st.rerun()
+                    STORE.invalidate()
+                    st.success("저장됨"); time.sleep(0.5); rerun()
+            if m_c=="수정" and st.button("삭제", type="primary", key="del_char"):
+                 delete_json("characters", f"{sel_cid}.json"); STORE.invalidate(); rerun()
                  
         with c2:
             st.subheader("👤 페르소나")
@@ -471,14 +926,17 @@ if sel_cid:
             if st.button("페르소나 저장"):
                 if nuid:
                     save_json("users", f"{nuid}.json", {"name":nunm, "gender":nugen, "age":nuage, "profile":nuprof})
-                    st.success("저장됨"); time.sleep(0.5); st.rerun()
-            if m_u=="수정" and sel_uid!="default" and st.button("삭제", type="primary"):
-                delete_json("users", f"{sel_uid}.json"); st.rerun()
+                    STORE.invalidate()
+                    st.success("저장됨"); time.sleep(0.5); rerun()
+            if m_u=="수정" and sel_uid!="default" and st.button("삭제", type="primary", key="del_user"):
+                delete_json("users", f"{sel_uid}.json"); STORE.invalidate(); rerun()
 
 else:
     with tab3:
         st.info("첫 캐릭터를 만드세요.")
         ni = st.text_input("ID"); nn = st.text_input("Name")
-        if st.button("Create"): save_json("characters", f"{ni}.json", {"name":nn}); st.rerun()
-
+        if st.button("Create"): save_json("characters", f"{ni}.json", {"name":nn}); STORE.invalidate(); rerun()
 
+# 이번 리런에서 쌓인 쓰기 반영
+STORE.flush()
+tracing.finish(st.session_state["trace_run"])
@@ -0,0 +1,265 @@
+"""
+벤치마크용 가짜 구글 시트 / Gemini. 네트워크 없이 실제 코드 경로를 그대로 태움.
+
+FakeWorksheet : gspread Worksheet 흉내 (메모리). 호출마다 지연(기본 + KB당)을 넣고
+                분당 읽기/쓰기 쿼터를 넘으면 429 FakeAPIError. 호출 수/주고받은 바이트를 셈
+install_fake_genai(...) : sys.modules에 google.generativeai 대역을 넣음.
+                          토큰 속도(초당), 첫 토큰 지연, 답변 길이를 지정
+"""
+import re
+import sys
+import json
+import time
+import types
+import threading
+from collections import deque
+
+def size_of(x):
+    if isinstance(x, str): return len(x.encode("utf-8"))
+    if isinstance(x, dict): return sum(size_of(v) for v in x.values())
+    if isinstance(x, (list, tuple)): return sum(size_of(v) for v in x)
+    return 0
+
+class FakeAPIError(Exception):
+    """gspread.exceptions.APIError처럼 .code로 HTTP 상태를 알려줌 (ratelimit.status_of가 읽음)"""
+    def __init__(self, code, msg=""):
+        super().__init__(f"{code} {msg}"); self.code = code
+
+def _col(letters):
+    n = 0
+    for ch in letters: n = n * 26 + ord(ch.upper()) - 64
+    return n
+
+def _cell(a1):
+    m = re.fullmatch(r"([A-Za-z]*)(\d*)", a1)
+    return (_col(m.group(1)) if m.group(1) else None), (int(m.group(2)) if m.group(2) else None)
+
+class Meter:
+    """메서드별 호출 수 / 바이트(보낸 것 + 받은 것)"""
+    def __init__(self):
+        self.calls, self.bytes_in, self.bytes_out, self.lock = {}, {}, {}, threading.Lock()
+
+    def add(self, name, sent, recv):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.bytes_out[name] = self.bytes_out.get(name, 0) + sent
+            self.bytes_in[name] = self.bytes_in.get(name, 0) + recv
+
+    def snapshot(self):
+        with self.lock: return {"calls": dict(self.calls), "bytes_out": dict(self.bytes_out), "bytes_in": dict(self.bytes_in)}
+
+    def reset(self):
+        with self.lock: self.calls, self.bytes_in, self.bytes_out = {}, {}, {}
+
+class FakeWorksheet:
+    READS = {"find", "row_values", "col_values", "get_all_values", "get", "batch_get"}
+
+    def __init__(self, rows=(), latency_ms=0.0, per_kb_ms=0.0, read_quota=None, write_quota=None, row_count=1000, col_count=26):
+        self.data = [list(r) for r in rows]
+        self.row_count, self.col_count = max(row_count, len(self.data)), col_count
+        self.latency_ms, self.per_kb_ms = latency_ms, per_kb_ms
+        self.quota = {"read": read_quota, "write": write_quota} # 분당 요청 수 (None이면 무제한)
+        self.window = {"read": deque(), "write": deque()}
+        self.meter = Meter()
+        self.lock = threading.Lock()
+        self.id, self.spreadsheet = 0, FakeSpreadsheet(self)
+
+    # ---------- 공통 ----------
+    def _call(self, name, sent, fn):
+        kind = "read" if name in self.READS else "write"
+        now = time.monotonic()
+        with self.lock:
+            w, q = self.window[kind], self.quota[kind]
+            while w and now - w[0] > 60: w.popleft()
+            if q is not None and len(w) >= q:
+                self.meter.add(name + " (429)", 0, 0)
+                raise FakeAPIError(429, f"Quota exceeded for {kind} requests")
+            w.append(now)
+            result = fn()
+        recv = size_of(result)
+        delay = self.latency_ms + self.per_kb_ms * (sent + recv) / 1024
+        if delay: time.sleep(delay / 1000)
+        self.meter.add(name, sent, recv)
+        return result
+
+    def _row(self, r): return self.data[r-1] if 0 < r <= len(self.data) else []
+
+    def _set_row(self, r, values, col=1):
+        if r > self.row_count or col - 1 + len(values) > self.col_count: raise FakeAPIError(400, "exceeds grid limits")
+        while len(self.data) < r: self.data.append([])
+        row = self.data[r-1]
+        while len(row) < col - 1 + len(values): row.append("")
+        row[col-1:col-1+len(values)] = list(values)
+        while row and row[-1] == "": row.pop()
+
+    def _range(self, a1):
+        # "A:B", "B7", "7:7", "A3" → 2차원 목록
+        if ":" in a1:
+            lo, hi = a1.split(":")
+            (c1, r1), (c2, r2) = _cell(lo), _cell(hi)
+        else:
+            (c1, r1) = (c2, r2) = _cell(a1)
+        r1, r2 = r1 or 1, r2 or len(self.data)
+        c1 = c1 or 1
+        out = []
+        for r in range(r1, min(r2, len(self.data)) + 1):
+            row = self._row(r)
+            out.append(row[c1-1:c2] if c2 else row[c1-1:])
+        while out and not out[-1]: out.pop()
+        return out
+
+    # ---------- gspread 흉내 ----------
+    def get_all_values(self): return self._call("get_all_values", 0, lambda: [list(r) for r in self.data])
+    def col_values(self, col): return self._call("col_values", 0, lambda: [r[col-1] if len(r) >= col else "" for r in self.data])
+    def row_values(self, row): return self._call("row_values", 0, lambda: list(self._row(row)))
+    def get(self, a1): return self._call("get", 0, lambda: self._range(a1))
+    def batch_get(self, ranges): return self._call("batch_get", size_of(ranges), lambda: [self._range(a) for a in ranges])
+
+    def find(self, query, in_column=None):
+        def f():
+            for r, row in enumerate(self.data, 1):
+                for c, v in enumerate(row, 1):
+                    if v == query and (in_column is None or c == in_column): return types.SimpleNamespace(row=r, col=c, value=v)
+            return None
+        return self._call("find", size_of(query), f)
+
+    def update(self, range_name, values):
+        def f():
+            c, r = _cell(range_name.split(":")[0])
+            for i, row in enumerate(values): self._set_row(r + i, row, c or 1)
+            return {}
+        return self._call("update", size_of(values), f)
+
+    def batch_update(self, data):
+        def f():
+            for d in data:
+                c, r = _cell(d["range"].split(":")[0])
+                for i, row in enumerate(d["values"]): self._set_row(r + i, row, c or 1)
+            return {}
+        return self._call("batch_update", size_of([d["values"] for d in data]), f)
+
+    def append_row(self, values):
+        def f():
+            if len(self.data) + 1 > self.row_count: self.row_count = len(self.data) + 1
+            self._set_row(len(self.data) + 1, values); return {}
+        return self._call("append_row", size_of(values), f)
+
+    def append_rows(self, values):
+        def f():
+            start = len(self.data) + 1
+            self.row_count = max(self.row_count, start + len(values) - 1) # 시트처럼 모자란 행은 늘어남
+            for i, row in enumerate(values): self._set_row(start + i, row)
+            return {"updates": {"updatedRange": f"Sheet1!A{start}:Z{start + len(values) - 1}"}}
+        return self._call("append_rows", size_of(values), f)
+
+    def delete_rows(self, start, end=None):
+        def f():
+            del self.data[start-1:(end or start)]; self.row_count -= (end or start) - start + 1
+            return {}
+        return self._call("delete_rows", 0, f)
+
+    def resize(self, rows=None, cols=None):
+        def f():
+            if rows: self.row_count = rows
+            if cols: self.col_count = cols
+            return {}
+        return self._call("resize", 0, f)
+
+class FakeSpreadsheet:
+    """ws.spreadsheet 대역. batch_update는 deleteDimension(ROWS)만 흉내냄 (요청 순서대로 적용)"""
+    def __init__(self, ws): self.ws = ws
+
+    def batch_update(self, body):
+        ws = self.ws
+        def f():
+            for req in body["requests"]:
+                r = req["deleteDimension"]["range"]
+                del ws.data[r["startIndex"]:r["endIndex"]]; ws.row_count -= r["endIndex"] - r["startIndex"]
+            return {}
+        return ws._call("spreadsheet_batch_update", size_of(body), f)
+
+# ==========================================
+# Gemini 대역
+# ==========================================
+class FakeLLM:
+    """설정 + 호출 기록. install_fake_genai가 돌려줌"""
+    def __init__(self, tokens_per_sec=50.0, ttft_ms=300.0, reply_tokens=200, count_ms=20.0):
+        self.tokens_per_sec, self.ttft_ms, self.reply_tokens, self.count_ms = tokens_per_sec, ttft_ms, reply_tokens, count_ms
+        self.meter = Meter()
+
+    @staticmethod
+    def tokens(text): return len(text) // 2 + 1 # 한국어 기준 대략치
+
+def install_fake_genai(llm):
+    """google.generativeai / .caching / .types 대역을 sys.modules에 등록 (이미 import된 진짜 모듈도 덮음)"""
+    g = types.ModuleType("google.generativeai")
+    caching = types.ModuleType("google.generativeai.caching")
+    gtypes = types.ModuleType("google.generativeai.types")
+
+    class Usage:
+        def __init__(self, p, c): self.prompt_token_count, self.candidates_token_count = p, c
+
+    class Chunk:
+        def __init__(self, text, usage=None): self.text, self.usage_metadata = text, usage
+
+    class GenerativeModel:
+        def __init__(self, model_name, system_instruction=None, **kw):
+            self.model_name, self.system_instruction = model_name, system_instruction or ""
+
+        @classmethod
+        def from_cached_content(cls, cached_content, **kw): return cls(cached_content.model, cached_content.system_instruction)
+
+        def count_tokens(self, contents, **kw):
+            time.sleep(llm.count_ms / 1000)
+            llm.meter.add("count_tokens", size_of(contents), 0)
+            return types.SimpleNamespace(total_tokens=llm.tokens(contents))
+
+        def generate_content(self, contents, stream=False, **kw):
+            prompt = llm.tokens(self.system_instruction) + llm.tokens(contents if isinstance(contents, str) else str(contents))
+            words = ["토큰"] * llm.reply_tokens
+            usage = Usage(prompt, llm.reply_tokens)
+            llm.meter.add("generate_content", size_of(contents) + size_of(self.system_instruction), 0)
+            if not stream:
+                time.sleep(llm.ttft_ms / 1000 + llm.reply_tokens / llm.tokens_per_sec)
+                if getattr(kw.get("generation_config"), "response_mime_type", "") == "application/json": # 요약
+                    return Chunk(json.dumps({"summary": " ".join(words), "recent_event": "사건", "location": "장소"}, ensure_ascii=False), usage)
+                return Chunk(" ".join(words), usage)
+            def gen():
+                time.sleep(llm.ttft_ms / 1000)
+                step = 10 # 조각 하나에 토큰 10개
+                for i in range(0, len(words), step):
+                    part = words[i:i+step]
+                    if i: time.sleep(len(part) / llm.tokens_per_sec)
+                    yield Chunk(" ".join(part) + " ", usage if i + step >= len(words) else None)
+            return gen()
+
+    class CachedContent:
+        @classmethod
+        def create(cls, model, system_instruction=None, ttl=None, **kw):
+            llm.meter.add("cache_create", size_of(system_instruction), 0)
+            return types.SimpleNamespace(model=model, system_instruction=system_instruction or "")
+
+    def list_models(**kw):
+        llm.meter.add("list_models", 0, 0)
+        return [types.SimpleNamespace(name=n, supported_generation_methods=["generateContent"]) for n in ("models/gemini-1.5-flash", "models/gemini-1.5-pro")]
+
+    class GenerationConfig:
+        def __init__(self, **kw): self.__dict__.update(kw)
+
+    class HarmCategory:
+        HARM_CATEGORY_HARASSMENT, HARM_CATEGORY_HATE_SPEECH, HARM_CATEGORY_SEXUALLY_EXPLICIT, HARM_CATEGORY_DANGEROUS_CONTENT = range(4)
+
+    class HarmBlockThreshold:
+        BLOCK_NONE = 0
+
+    g.configure = lambda **kw: None
+    g.GenerativeModel, g.list_models = GenerativeModel, list_models
+    caching.CachedContent = CachedContent
+    gtypes.GenerationConfig, gtypes.HarmCategory, gtypes.HarmBlockThreshold = GenerationConfig, HarmCategory, HarmBlockThreshold
+    g.caching, g.types = caching, gtypes
+    try: import google # protobuf 등 진짜 google.* 패키지는 그대로 두고 generativeai만 바꿈
+    except ImportError:
+        google = types.ModuleType("google"); google.__path__ = []
+    google.generativeai = g
+    sys.modules.update({"google": google, "google.generativeai": g, "google.generativeai.caching": caching, "google.generativeai.types": gtypes})
+    return g
@@ -0,0 +1,231 @@
+"""
+오프라인 벤치마크. 가짜 시트/Gemini(bench/fakes.py) 위에서 app.py를 streamlit AppTest로 그대로 돌림.
+
+  python bench/run.py                          전체 시나리오
+  python bench/run.py send_message long_session --latency 80
+  python bench/run.py --record bench/baseline.json   결과 저장
+  python bench/run.py --baseline bench/baseline.json 저장한 결과와 비교 (시간/호출/바이트 증감)
+
+시나리오마다 st.cache_resource를 비워 프로세스를 새로 띄운 것과 같은 상태에서 시작하고,
+준비 단계(데이터 채우기, 예열)는 재지 않음. 보고: 걸린 시간, 시트 메서드별 호출 수/바이트, Gemini 호출 수.
+측정 전에는 앞 단계가 뒤에서 돌리던 작업(요약, 미리 읽기, 쓰기 대기열)을 끝내 두고,
+측정 뒤에도 그 단계가 시작한 작업이 끝날 때까지 기다린 다음 호출 수를 셈 (시간에는 넣지 않음).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import fakes  # noqa: E402
+
+LLM = fakes.FakeLLM()
+fakes.install_fake_genai(LLM) # app/llm_gateway보다 먼저
+
+import streamlit as st  # noqa: E402
+import streamlit.logger  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+import storage  # noqa: E402
+
+streamlit.logger.set_log_level("error") # AppTest 밖에서 cache를 비울 때 나오는 경고
+
+# 앱이 뒤에서 돌리는 작업: 스레드 풀(요약/미리 읽기/LLM 헤징)의 future와 시트 쓰기 대기열
+APP_POOLS = {"summary", "prefetch", "llm"}
+BACKGROUND, QUEUES = [], []
+
+class _TrackedExecutor(concurrent.futures.ThreadPoolExecutor):
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.tracked = kw.get("thread_name_prefix") in APP_POOLS
+
+    def submit(self, *a, **kw):
+        f = super().submit(*a, **kw)
+        if self.tracked: BACKGROUND.append(f)
+        return f
+
+class _TrackedQueue(storage.WriteQueue):
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw); QUEUES.append(self)
+
+concurrent.futures.ThreadPoolExecutor = _TrackedExecutor # app/llm_gateway가 import하기 전
+storage.WriteQueue = _TrackedQueue
+
+def settle():
+    # 뒤에서 돌던 작업이 모두 끝나고(그 작업이 새로 시작한 것까지) 대기 쓰기가 시트에 반영될 때까지
+    while BACKGROUND:
+        concurrent.futures.wait(BACKGROUND)
+        BACKGROUND[:] = [f for f in BACKGROUND if not f.done()]
+        for q in QUEUES: q.flush()
+    for q in QUEUES: q.flush()
+
+APP = os.path.join(ROOT, "app.py")
+PROFILE = "config_master.json"
+SHEET = None # 지금 시나리오의 FakeWorksheet (storage.open_sheet가 돌려줌)
+WORKSHEETS = {} # 이름 → 같은 스프레드시트의 다른 워크시트 (회상 색인 등). 지연/쿼터/계측은 SHEET과 공유
+def _open_sheet(gcp_info, sheet_id, worksheet=None):
+    if not worksheet: return SHEET
+    ws = WORKSHEETS.get(worksheet)
+    if ws is None:
+        ws = WORKSHEETS[worksheet] = fakes.FakeWorksheet()
+        ws.meter, ws.window = SHEET.meter, SHEET.window
+        ws.latency_ms, ws.per_kb_ms, ws.quota = SHEET.latency_ms, SHEET.per_kb_ms, SHEET.quota
+    return ws
+storage.open_sheet = _open_sheet
+
+def secrets(opts):
+    return {"general": {"PASSWORD": "bench", "GOOGLE_API_KEY": "x", "SHEET_ID": "bench", "STORAGE": "sheets",
+                        "SHEETS_READ_RPM": opts.read_rpm, "SHEETS_WRITE_RPM": opts.write_rpm, "GEMINI_RPM": 1000, "LLM_HEDGE_PCT": 0},
+            "gcp": {"info": "{}"}}
+
+# ==========================================
+# 데이터 준비
+# ==========================================
+def seed(opts, history=0, lorebooks=0, legacy_history=False):
+    """캐릭터 3 / 페르소나 2 / 설정 / 대화 history개를 실제 저장 형식으로 넣은 시트"""
+    global SHEET
+    SHEET = fakes.FakeWorksheet()
+    WORKSHEETS.clear()
+    be = storage.SheetsBackend(SHEET)
+    put = lambda key, data: be.put(key, json.dumps(data, ensure_ascii=False))
+    lore = [{"tags": f"태그{i},키워드{i}", "content": f"설정 {i}: " + "세계관 설명 " * 20} for i in range(lorebooks)]
+    for i in range(3):
+        put(f"characters/c{i}.json", {"name": f"캐릭터{i}", "description": "설명 " * 50, "system_prompt": "프롬프트 " * 200, "first_message": "안녕!", "lorebooks": lore if i == 0 else []})
+    for i in range(2): put(f"users/u{i}.json", {"name": f"유저{i}", "gender": "?", "age": "20", "profile": "여행자"})
+    for prof in ("config_master.json", "config_friend.json"):
+        put(f"config/{prof}", {"chat_model": "models/gemini-1.5-flash", "last_user_id": "u0", "last_char_id": "c0"})
+    # 요약은 최근 SUMMARY_KEEP_RECENT개 앞까지 따라잡은 상태 (평소 쓰던 대화). 아니면 리런마다 밀린 요약이 하나씩 돎
+    put("memory/c0.json", {"summary": "요약 " * 200, "recent_event": "", "location": "마을", "covered": {"c0__Default.json": max(history - 20, 0)}})
+    msgs = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"{i}번째 메시지. 태그{i % max(lorebooks, 1)} 이야기를 이어간다. " * 3} for i in range(history)]
+    if history: put("history/c0__Default.json", msgs) # 예전 단일 행 형식 → 아래 예열 때 앱이 페이지로 옮김
+    be.flush()
+    if history: new_app(opts).run()
+    for ws in [SHEET, *WORKSHEETS.values()]:
+        ws.latency_ms, ws.per_kb_ms = opts.latency, opts.per_kb
+        ws.quota = {"read": opts.read_quota, "write": opts.write_quota}
+
+def new_app(opts, profile=PROFILE):
+    settle() # 예열한 앱의 요약/쓰기가 새 앱의 시트 사용에 섞이지 않게
+    st.cache_resource.clear() # 새 프로세스와 같은 상태
+    at = AppTest.from_file(APP, default_timeout=opts.timeout)
+    for k, v in secrets(opts).items(): at.secrets[k] = v
+    at.session_state["password_correct"] = True
+    at.session_state["current_profile_key"] = profile
+    return at
+
+def last_index(at):
+    # 화면에 그려진 메시지 버튼 키(e_{idx})에서 마지막 인덱스
+    return max(int(b.key[2:]) for b in at.button if b.key and b.key.startswith("e_"))
+
+# ==========================================
+# 시나리오: (준비, 측정) → 측정 함수만 잼
+# ==========================================
+def sc_cold_start(opts):
+    seed(opts, history=200); at = new_app(opts)
+    return at, lambda: at.run()
+
+def sc_warm_rerun(opts):
+    seed(opts, history=200); at = new_app(opts); at.run()
+    return at, lambda: at.run()
+
+def sc_profile_switch(opts):
+    seed(opts, history=200); at = new_app(opts); at.run()
+    def go():
+        at.session_state["current_profile_key"] = "config_friend.json"; at.run()
+    return at, go
+
+def sc_send_message(opts):
+    seed(opts, history=200); at = new_app(opts); at.run()
+    return at, lambda: at.chat_input[0].set_value("오늘은 뭐 할까?").run()
+
+def sc_regenerate(opts):
+    seed(opts, history=200); at = new_app(opts); at.run() # 짝수 개 → 마지막이 assistant
+    return at, lambda: at.button(key=f"r_{last_index(at)}").click().run()
+
+def sc_edit_at_index(opts):
+    seed(opts, history=200); at = new_app(opts); at.run()
+    idx = last_index(at) - 10
+    at.button(key=f"e_{idx}").click().run()
+    def go():
+        at.text_area(key=f"t_{idx}").set_value("고친 내용")
+        at.button(key=f"s_{idx}").click().run()
+    return at, go
+
+def sc_long_session(opts):
+    seed(opts, history=10000); at = new_app(opts)
+    def go():
+        at.run(); at.chat_input[0].set_value("처음에 했던 약속 기억나?").run()
+    return at, go
+
+def sc_lorebook_500(opts):
+    seed(opts, history=100, lorebooks=500); at = new_app(opts); at.run()
+    return at, lambda: at.chat_input[0].set_value("태그7 이야기랑 키워드42 얘기 좀 해줘").run()
+
+SCENARIOS = {"cold_start": sc_cold_start, "warm_rerun": sc_warm_rerun, "profile_switch": sc_profile_switch, "send_message": sc_send_message,
+             "regenerate": sc_regenerate, "edit_at_index": sc_edit_at_index, "long_session": sc_long_session, "lorebook_500": sc_lorebook_500}
+
+def run_one(name, opts):
+    at, go = SCENARIOS[name](opts)
+    settle()
+    SHEET.meter.reset(); LLM.meter.reset()
+    t0 = time.perf_counter()
+    go()
+    wall = time.perf_counter() - t0
+    settle() # 이 단계가 뒤로 미룬 요약/쓰기도 호출 수에 넣음
+    sheet, llm = SHEET.meter.snapshot(), LLM.meter.snapshot()
+    return {"wall_s": round(wall, 3),
+            "sheet_calls": sum(sheet["calls"].values()),
+            "sheet_bytes": sum(sheet["bytes_in"].values()) + sum(sheet["bytes_out"].values()),
+            "llm_calls": sum(llm["calls"].values()),
+            "sheet": sheet["calls"], "llm": llm["calls"],
+            "errors": [str(e.value) for e in at.exception] + [str(e.value) for e in at.error]} # 시나리오가 실제로 성공했는지
+
+def _delta(now, base):
+    if not base: return ""
+    return f"{(now - base) / base * 100:+.0f}%" if base else ""
+
+def report(results, baseline=None):
+    baseline = baseline or {}
+    print(f"{'scenario':<16}{'wall_s':>9}{'':>7}{'sheet_calls':>12}{'':>7}{'sheet_KB':>10}{'':>7}{'llm_calls':>10}")
+    for name, r in results.items():
+        b = baseline.get(name, {})
+        print(f"{name:<16}{r['wall_s']:>9.3f}{_delta(r['wall_s'], b.get('wall_s')):>7}{r['sheet_calls']:>12}{_delta(r['sheet_calls'], b.get('sheet_calls')):>7}"
+              f"{r['sheet_bytes'] / 1024:>10.1f}{_delta(r['sheet_bytes'], b.get('sheet_bytes')):>7}{r['llm_calls']:>10}")
+        print(f"{'':<16}sheet {r['sheet']}  llm {r['llm']}")
+        for e in r["errors"]: print(f"{'':<16}!! {e}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="가짜 시트/Gemini로 app.py 시나리오 벤치마크")
+    ap.add_argument("scenarios", nargs="*", choices=[[], *SCENARIOS], help="기본: 전체")
+    ap.add_argument("--latency", type=float, default=50.0, help="시트 호출당 지연 ms")
+    ap.add_argument("--per-kb", type=float, default=0.5, help="주고받은 KB당 추가 지연 ms")
+    ap.add_argument("--read-quota", type=int, help="분당 시트 읽기 쿼터 (넘으면 429)")
+    ap.add_argument("--write-quota", type=int, help="분당 시트 쓰기 쿼터")
+    ap.add_argument("--read-rpm", type=int, default=6000, help="앱 쪽 읽기 한도 (SHEETS_READ_RPM)")
+    ap.add_argument("--write-rpm", type=int, default=6000, help="앱 쪽 쓰기 한도 (SHEETS_WRITE_RPM)")
+    ap.add_argument("--tokens-per-sec", type=float, default=200.0)
+    ap.add_argument("--ttft", type=float, default=300.0, help="첫 토큰까지 ms")
+    ap.add_argument("--reply-tokens", type=int, default=200)
+    ap.add_argument("--timeout", type=float, default=300.0, help="AppTest 한 번 실행 제한 (초)")
+    ap.add_argument("--record", help="결과를 JSON으로 저장")
+    ap.add_argument("--baseline", help="저장한 결과와 비교")
+    opts = ap.parse_args(argv)
+    LLM.tokens_per_sec, LLM.ttft_ms, LLM.reply_tokens = opts.tokens_per_sec, opts.ttft, opts.reply_tokens
+    results = {}
+    for name in opts.scenarios or SCENARIOS:
+        print(f"running {name}...", file=sys.stderr)
+        results[name] = run_one(name, opts)
+    baseline = None
+    if opts.baseline:
+        with open(opts.baseline, encoding="utf-8") as f: baseline = json.load(f)["results"]
+    report(results, baseline)
+    if opts.record:
+        with open(opts.record, "w", encoding="utf-8") as f:
+            json.dump({"recorded_at": time.strftime("%Y-%m-%d %H:%M:%S"), "options": vars(opts), "results": results}, f, ensure_ascii=False, indent=1)
+    return 1 if any(r["errors"] for r in results.values()) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""
+Gemini 호출 창구. 앱에서는 st.cache_resource로 하나만 만들어 모든 세션이 공유.
+
+  models()                    generateContent 지원 모델 목록. MODEL_LIST_TTL이 지나면 옛 목록을 바로 주고 뒤에서 갱신
+  model(model_id, instr)      설정이 같은 GenerativeModel은 한 번만 만들어 재사용
+  generate(model, contents)   한도/재시도 + 제한시간(request_options timeout).
+                              응답(스트리밍이면 첫 조각)이 최근 지연의 p{hedge_pct}를 넘기면
+                              같은 요청을 하나 더 보내 먼저 온 쪽을 씀 (헤징)
+  count_tokens(model_id, t)   제한시간 있는 토큰 수 계산
+  stats()                     모델별 지연 통계 (p50/p95, 오류/시간초과/헤징 수)
+각 호출은 llm.* span으로 남음 (tracing.py): 토큰 수, 스트리밍 조각 수, 받은 글자 바이트
+
+설정 (secrets [general]): LLM_TIMEOUT, LLM_STREAM_TIMEOUT (초), LLM_HEDGE_PCT (기본 0 = 헤징 안 함. 95 등으로 켬 → 느린 요청은 두 번 과금될 수 있음)
+"""
+import time
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+import google.generativeai as genai
+import ratelimit
+import tracing
+
+MODEL_LIST_TTL = 3600
+MODEL_POOL_MAX = 64
+TIMEOUT = 120          # 초. 일반 요청 (재시도 포함 전체)
+STREAM_TIMEOUT = 300   # 스트리밍 요청 전체
+COUNT_TIMEOUT = 10     # count_tokens / list_models
+HEDGE_PCT = 0          # 헤징은 켜야 동작 (요청/과금이 늘어남)
+HEDGE_MIN_SAMPLES = 20 # 지연 표본이 이보다 적으면 헤징 안 함
+LATENCY_WINDOW = 200   # 모델별로 남길 최근 지연 표본 수
+
+class LatencyStats:
+    """최근 LATENCY_WINDOW개 지연(초) + 누적 횟수. 스트리밍은 첫 조각까지의 시간"""
+    def __init__(self):
+        self.samples = deque(maxlen=LATENCY_WINDOW)
+        self.calls = self.errors = self.timeouts = self.hedged = self.hedge_wins = 0
+
+    def percentile(self, pct):
+        if not self.samples: return None
+        s = sorted(self.samples)
+        return s[min(len(s) - 1, int(len(s) * pct / 100))]
+
+    def summary(self):
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {"calls": self.calls, "errors": self.errors, "timeouts": self.timeouts, "hedged": self.hedged, "hedge_wins": self.hedge_wins,
+                "p50": round(p50, 2) if p50 is not None else None, "p95": round(p95, 2) if p95 is not None else None}
+
+def _is_timeout(e): return isinstance(e, TimeoutError) or ratelimit.status_of(e) == 504 or type(e).__name__ == "DeadlineExceeded"
+
+def _chain(first, rest):
+    if first is not None: yield first
+    yield from rest
+
+def _discard(f):
+    # 헤징 경주에서 진 쪽: 스트림이면 받던 응답을 닫아 남은 조각을 더 받지 않음
+    if f.cancelled() or f.exception() is not None: return
+    r = f.result()
+    if not isinstance(r, tuple): return
+    for name in ("close", "cancel"):
+        fn = getattr(r[1], name, None)
+        if fn:
+            try: fn()
+            except Exception: pass
+
+def _usage(sp, resp):
+    um = getattr(resp, "usage_metadata", None)
+    if um: sp.set(tokens_in=getattr(um, "prompt_token_count", 0), tokens_out=getattr(um, "candidates_token_count", 0))
+
+def _text_bytes(resp):
+    try: return len(resp.text.encode("utf-8"))
+    except Exception: return 0 # 안전 필터 등으로 텍스트 없음
+
+def _traced_stream(sp, first, rest):
+    # 다 받거나 중간에 버려질 때 span을 닫음. 토큰 수는 마지막 조각의 usage_metadata
+    last = None
+    try:
+        for c in _chain(first, rest):
+            sp.add(chunks=1, bytes=_text_bytes(c)); last = c
+            yield c
+    except Exception as e:
+        sp.set(error=type(e).__name__); raise
+    finally:
+        if last is not None: _usage(sp, last)
+        sp.end()
+
+class Gateway:
+    def __init__(self, bucket=None, timeout=TIMEOUT, stream_timeout=STREAM_TIMEOUT, hedge_pct=HEDGE_PCT):
+        self.bucket = bucket # ratelimit.TokenBucket (헤징으로 보낸 요청도 한도에 포함)
+        self.timeout, self.stream_timeout, self.hedge_pct = timeout, stream_timeout, hedge_pct
+        self.lock = threading.Lock()
+        self.pool = OrderedDict()   # (model_id, system_instruction sha1) → GenerativeModel (LRU)
+        self.lat = {}               # (model_name, stream) → LatencyStats
+        self.model_list, self.listed_at, self.refreshing = None, 0.0, False
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm")
+
+    # ---------- 모델 ----------
+    def models(self):
+        with self.lock:
+            ms, stale = self.model_list, time.time() - self.listed_at > MODEL_LIST_TTL
+            if ms and stale and not self.refreshing:
+                self.refreshing = True; self.executor.submit(self._refresh_models)
+        return ms or self._refresh_models()
+
+    def _refresh_models(self):
+        try:
+            with tracing.span("llm.list_models"): found = ratelimit.call(None, lambda: list(genai.list_models(request_options={"timeout": COUNT_TIMEOUT})), retries=2)
+            ms = sorted(m.name for m in found if "generateContent" in m.supported_generation_methods)
+            with self.lock: self.model_list, self.listed_at = ms, time.time()
+            return ms
+        except Exception as e:
+            print(f"Model List Error: {e}")
+            if self.model_list: return self.model_list
+            raise
+        finally: self.refreshing = False
+
+    def model(self, model_id, system_instruction=None):
+        key = (model_id, hashlib.sha1(system_instruction.encode("utf-8")).hexdigest() if system_instruction else None)
+        with self.lock:
+            m = self.pool.get(key)
+            if m is not None: self.pool.move_to_end(key); return m
+        m = genai.GenerativeModel(model_id, system_instruction=system_instruction)
+        with self.lock:
+            self.pool[key] = m
+            while len(self.pool) > MODEL_POOL_MAX: self.pool.popitem(last=False)
+        return m
+
+    def count_tokens(self, model_id, text):
+        with tracing.span("llm.count_tokens", model=model_id) as sp:
+            n = self.model(model_id).count_tokens(text, request_options={"timeout": COUNT_TIMEOUT}).total_tokens
+            sp.set(tokens=n); return n
+
+    # ---------- 생성 ----------
+    def _stats(self, name, stream):
+        with self.lock: return self.lat.setdefault((name, stream), LatencyStats())
+
+    def generate(self, model, contents, stream=False, hedge=True, **kwargs):
+        """model.generate_content와 같음. stream이면 조각 이터레이터 (첫 조각은 이미 받아 둔 상태)"""
+        name = getattr(model, "model_name", "?")
+        stats = self._stats(name, stream)
+        deadline = time.monotonic() + (self.stream_timeout if stream else self.timeout)
+
+        def attempt():
+            left = deadline - time.monotonic()
+            if left <= 0: raise TimeoutError("LLM 요청 제한시간 초과")
+            resp = model.generate_content(contents, stream=stream, request_options={"timeout": left}, **kwargs)
+            if not stream: return resp
+            rest = iter(resp)
+            return next(rest, None), rest # 첫 조각 오류도 재시도 대상
+
+        run = lambda: ratelimit.call(self.bucket, attempt, deadline=deadline)
+        after = stats.percentile(self.hedge_pct) if hedge and self.hedge_pct and len(stats.samples) >= HEDGE_MIN_SAMPLES else None
+        sp = tracing.begin("llm.generate", model=name, stream=stream)
+        t0 = time.monotonic()
+        try: r = run() if after is None else self._race(run, after, stats, sp)
+        except Exception as e:
+            with self.lock:
+                stats.errors += 1
+                if _is_timeout(e): stats.timeouts += 1
+            sp.set(error=type(e).__name__); sp.end()
+            raise
+        took = time.monotonic() - t0
+        with self.lock: stats.calls += 1; stats.samples.append(took)
+        if stream:
+            sp.set(first_ms=round(took * 1000, 1))
+            return _traced_stream(sp, *r)
+        _usage(sp, r); sp.set(bytes=_text_bytes(r)); sp.end()
+        return r
+
+    def _race(self, run, after, stats, sp):
+        # after초 안에 안 오면 같은 요청을 하나 더. 먼저 성공한 쪽을 쓰고 늦은 쪽은 취소하거나 끝나는 대로 닫음
+        futs = [self.executor.submit(tracing.bind(run))]
+        if not wait(futs, timeout=after).done:
+            futs.append(self.executor.submit(tracing.bind(run)))
+            sp.set(hedged=True)
+            with self.lock: stats.hedged += 1
+        err = None
+        for f in as_completed(futs):
+            try: r = f.result()
+            except Exception as e:
+                err = err or e; continue
+            if f is not futs[0]:
+                with self.lock: stats.hedge_wins += 1
+            for g in futs:
+                if g is not f and not g.cancel(): g.add_done_callback(_discard)
+            return r
+        raise err
+
+    def stats(self):
+        # {"모델명" 또는 "모델명 (stream)": summary()}
+        with self.lock: return {name + (" (stream)" if s else ""): v.summary() for (name, s), v in self.lat.items()}
+
+def open_gateway(general=None, bucket=None):
+    general = general or {}
+    return Gateway(bucket, float(general.get("LLM_TIMEOUT", TIMEOUT)), float(general.get("LLM_STREAM_TIMEOUT", STREAM_TIMEOUT)), float(general.get("LLM_HEDGE_PCT", HEDGE_PCT)))
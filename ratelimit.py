@@ -0,0 +1,115 @@
+"""
+API 호출 한도(token bucket) + 재시도(지수 백오프 + jitter).
+
+버킷은 프로세스 전체가 공유해야 의미가 있으므로 앱에서는 st.cache_resource로 한 번만 만듦.
+  sheets_read / sheets_write : 구글 시트 (기본 분당 60회, 사용자별 기본 쿼터)
+  gemini                     : 답변/요약 생성 요청
+"""
+import time
+import random
+import threading
+import tracing
+
+try:
+    import requests
+    NETWORK_ERRORS = (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout)
+except ImportError:
+    NETWORK_ERRORS = (ConnectionError, TimeoutError)
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RETRY_MAX = 5
+BACKOFF_BASE = 1.0 # 초
+BACKOFF_CAP = 32.0
+
+class TokenBucket:
+    """분당 rate개. burst만큼 몰아 쓸 수 있고, 모자라면 채워질 때까지 기다림"""
+    def __init__(self, rate_per_min, burst=None):
+        self.rate = rate_per_min / 60.0
+        self.capacity = float(burst or max(1, rate_per_min // 6))
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1; return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def drain(self):
+        # 429를 받음 → 다른 스레드도 함께 속도를 늦추도록 비움
+        with self.lock:
+            self._refill(); self.tokens = min(self.tokens, 0.0)
+
+def default_limiters(general=None):
+    # general: secrets의 [general]. SHEETS_READ_RPM / SHEETS_WRITE_RPM / GEMINI_RPM 으로 조정
+    general = general or {}
+    return {
+        "sheets_read": TokenBucket(int(general.get("SHEETS_READ_RPM", 60))),
+        "sheets_write": TokenBucket(int(general.get("SHEETS_WRITE_RPM", 60))),
+        "gemini": TokenBucket(int(general.get("GEMINI_RPM", 60))),
+    }
+
+def status_of(e):
+    # gspread APIError / google.api_core 예외 / requests HTTPError 의 HTTP 상태 코드
+    code = getattr(e, "code", None)
+    if code is None and getattr(e, "response", None) is not None: code = getattr(e.response, "status_code", None)
+    try: return int(code)
+    except (TypeError, ValueError): return None
+
+def is_retryable(e, idempotent=True):
+    # 멱등이 아닌 호출(행 삭제 등)은 서버가 거절한 게 확실한 429만 재시도
+    status = status_of(e)
+    if not idempotent: return status == 429
+    return status in RETRYABLE_STATUS or isinstance(e, NETWORK_ERRORS)
+
+def call(bucket, fn, *args, idempotent=True, retries=RETRY_MAX, deadline=None, **kwargs):
+    """bucket 토큰을 받고 fn 호출. 일시적 오류는 full jitter 백오프로 재시도, 나머지는 그대로 raise
+    deadline(time.monotonic 기준)을 주면 기다린 뒤 그 시각을 넘길 재시도는 하지 않음"""
+    for attempt in range(retries + 1):
+        if bucket is not None: bucket.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e, idempotent): raise
+            if bucket is not None and status_of(e) == 429: bucket.drain()
+            wait = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            if deadline is not None and time.monotonic() + wait >= deadline: raise
+            time.sleep(wait)
+
+class LimitedSheet:
+    """gspread Worksheet 래퍼. 읽기/쓰기 호출을 각 버킷 + 재시도로 감싸고 sheets.{메서드} span을 남김 (나머지 속성은 그대로)"""
+    READS = {"get_all_values", "col_values", "row_values", "batch_get", "get"}
+    WRITES = {"batch_update", "update", "resize"}
+    UNSAFE = {"delete_rows", "append_row", "append_rows"} # 재실행하면 다른 행이 지워지거나 같은 행이 두 번 붙을 수 있음
+
+    def __init__(self, sheet, limiters):
+        self._sheet, self._limiters = sheet, limiters
+
+    def delete_row_ranges(self, ranges):
+        # [(시작 행, 끝 행)] 여러 구간을 spreadsheets.batchUpdate 한 번으로. 아래 구간부터 지워야 앞 구간 번호가 안 밀림
+        ws = self._sheet
+        reqs = [{"deleteDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": s - 1, "endIndex": e}}} for s, e in sorted(ranges, reverse=True)]
+        with tracing.span("sheets.delete_row_ranges", ranges=len(reqs)):
+            return call(self._limiters["sheets_write"], ws.spreadsheet.batch_update, {"requests": reqs}, idempotent=False) # 재실행하면 다른 행이 지워질 수 있음
+
+    def __getattr__(self, name):
+        attr = getattr(self._sheet, name)
+        if name in self.READS: bucket, idem = self._limiters["sheets_read"], True
+        elif name in self.WRITES: bucket, idem = self._limiters["sheets_write"], True
+        elif name in self.UNSAFE: bucket, idem = self._limiters["sheets_write"], False
+        else: return attr
+        def traced(*a, **kw):
+            with tracing.span(f"sheets.{name}") as sp:
+                r = call(bucket, attr, *a, idempotent=idem, **kw)
+                sp.set(bytes=tracing.size_of(r) if name in self.READS else tracing.size_of((a, kw)))
+                return r
+        return traced
@@ -0,0 +1,60 @@
+"""
+대화 회상용 로컬 벡터 색인 (해싱 TF-IDF). 네트워크/임베딩 모델 없이 동작.
+
+메시지 → 단어 + 글자 1~2-gram을 DIM칸에 부호 해싱 → 1+log(tf) → int8 양자화.
+history 페이지마다 한 행으로 저장 (history_index/{파일}#{id}): {"n": 메시지 수, "q": base85(zlib(int8 n×DIM))}
+대부분 0인 벡터라 base85 전에 압축해야 줄어듦 (압축 안 한 예전 형식도 읽음)
+검색 때 불러온 색인 전체의 문서 빈도로 IDF를 곱하고 코사인 유사도로 순위.
+"""
+import zlib
+import base64
+import functools
+import numpy as np
+
+DIM = 1024
+NGRAMS = (1, 2) # 한국어는 단어보다 글자 1~2-gram이 조사/어미 변화에 덜 민감
+
+def _grams(text):
+    t = " ".join(text.lower().split())
+    for w in t.split():
+        if len(w) > 1: yield "w:" + w
+    for n in NGRAMS:
+        for i in range(len(t) - n + 1):
+            g = t[i:i+n]
+            if " " not in g[1:-1] and not g.isspace(): yield g
+
+@functools.lru_cache(maxsize=4096)
+def embed(text):
+    # text → int8 DIM개 (bytes). 같은 문장은 페이지를 다시 저장할 때 재계산하지 않음
+    hs = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in _grams(text)), np.uint32)
+    v = np.zeros(DIM, np.float32)
+    if hs.size: np.add.at(v, hs % DIM, np.where(hs & 0x80000000, 1.0, -1.0).astype(np.float32))
+    v = np.sign(v) * np.log1p(np.abs(v))
+    m = np.abs(v).max()
+    return (v * (127 / m)).round().astype(np.int8).tobytes() if m else bytes(DIM)
+
+def encode_page(texts):
+    return base64.b85encode(zlib.compress(b"".join(embed(t) for t in texts), 9)).decode("ascii")
+
+def decode_page(q, n):
+    # 메시지 수가 안 맞으면(수정 중 충돌, 예전 형식) None → 호출 쪽에서 다시 만듦
+    try: b = base64.b85decode(q)
+    except ValueError: return None
+    try: b = zlib.decompress(b)
+    except zlib.error: pass # 압축 전 형식
+    a = np.frombuffer(b, np.int8)
+    return a.reshape(n, DIM) if a.size == n * DIM else None
+
+def search(query, pages, k, min_score=0.0, limit=None):
+    # pages: decode_page 결과 목록 (이어 붙여 한 행렬로, 앞에서 limit행만) → [(행 번호, 점수)] 점수 높은 순
+    if not pages or k <= 0: return []
+    x = np.concatenate(pages)[:limit].astype(np.float32)
+    if not len(x): return []
+    idf = np.log((1 + len(x)) / (1 + np.count_nonzero(x, axis=0))) + 1 # 흔한 조각(어미, 조사)의 비중을 낮춤
+    x *= idf
+    x /= np.linalg.norm(x, axis=1, keepdims=True) + 1e-9
+    q = np.frombuffer(embed(query), np.int8).astype(np.float32) * idf
+    q /= np.linalg.norm(q) + 1e-9
+    s = x @ q
+    top = np.argpartition(-s, k - 1)[:k] if len(s) > k else np.arange(len(s))
+    return [(int(i), float(s[i])) for i in sorted(top, key=lambda i: -s[i]) if s[i] >= min_score]
@@ -0,0 +1,679 @@
+"""
+저장소 백엔드. 키는 'folder/filename', 값은 JSON 원문.
+
+- SheetsBackend : 구글 시트 (A열 키, B열 버전 '#v{n}@{unix}', C열부터 CHUNK_SIZE 조각.
+                  긴 값은 zlib+base85 압축. 버전 없는 예전 행은 B열부터 조각)
+- SQLiteBackend : 로컬 SQLite (WAL)
+
+두 백엔드는 같은 메서드를 가짐:
+  view()                      이번 리런 동안 읽을 대상 (get / scan / version)
+  fetch(keys)                 그 키들만 읽음 → {key: raw} (시트면 스냅샷 없이 해당 행만)
+  put(key, raw, view, expect) 저장 → 새 버전. expect와 현재 버전이 다르면 VersionConflict
+  delete(key, view)           삭제     delete_many(keys, view)   여러 키를 한 번에 삭제 → 지운 수
+  flush()                     대기 쓰기 반영     invalidate()        다음 view()에서 동기화
+  conflicts_since(ts)         ts 이후 버전 충돌로 버려진 쓰기의 키
+  items()                     (key, raw) 전체
+  stream()                    (key, raw)를 조금씩 읽으며 내보냄 (백업/마이그레이션용)
+
+마이그레이션:  python storage.py migrate sheets sqlite [--db chat.db]
+시트 재인코딩: python storage.py reencode [--plain]
+워크시트 분리: python storage.py move history_index/ --worksheet history_index
+               (open_backend(..., worksheet=)로 여는 별도 워크시트로 옮김. 앱 시작 때 받는 본 시트를 가볍게)
+백업:          python storage.py export backup.jsonl.gz [--from sheets]   (.gz면 gzip)
+복원:          python storage.py import backup.jsonl.gz [--to sheets] [--batch 100]
+               중간에 끊기면 backup.jsonl.gz.ckpt에 반영된 줄 수가 남고, 다시 실행하면 거기서 이어감
+"""
+import json
+import os
+import re
+import sys
+import gzip
+import bisect
+import time
+import zlib
+import base64
+import sqlite3
+import threading
+import ratelimit
+import tracing
+
+CHUNK_SIZE = 40000
+INDEX_REBUILD_MIN_SEC = 30 # 없는 키 조회 시 재구축 최소 간격
+WRITE_BATCH_MAX = 20       # 대기 키가 이만큼 쌓이면 바로 flush
+WRITE_FLUSH_SEC = 2.0      # 가장 오래된 대기 쓰기가 이보다 오래되면 백그라운드에서 flush
+SNAPSHOT_TTL = 60          # 초. 이 프로세스의 쓰기는 즉시 반영되므로 외부 수정만 늦게 보임
+COMPRESS_PREFIX = "~z1:"   # 압축된 값의 첫 조각 머리표 (JSON은 '~'로 시작할 수 없음)
+COMPRESS_MIN = 2000        # 이보다 짧은 값은 압축하지 않음
+EXPORT_PAGE_ROWS = 500     # 내보내기 때 한 번에 읽을 행 수
+IMPORT_BATCH = 100         # 가져오기 때 batch_update 한 번에 쓸 키 수 (= 체크포인트 간격)
+
+class StorageError(Exception):
+    """저장소 값이 손상됐거나 읽을 수 없음 (빈 값으로 취급하면 다음 저장이 덮어씀)"""
+
+class VersionConflict(StorageError):
+    """읽은 뒤에 다른 세션/프로세스가 먼저 저장함 (덮어쓰지 않음)"""
+
+STAMP_RE = re.compile(r"#v(\d+)@\d+$")
+
+def make_stamp(ver): return f"#v{ver}@{int(time.time())}"
+
+def parse_stamp(cell):
+    m = STAMP_RE.match(cell or "")
+    return int(m.group(1)) if m else None
+
+def split_row(r):
+    # 시트 한 행 → (키, 버전, 이어 붙인 셀 문자열). 버전 열이 없는 예전 행은 버전 0
+    key = r[0] if r else ""
+    ver = parse_stamp(r[1]) if len(r) > 1 else None
+    if ver is not None: return key, ver, "".join(r[2:])
+    return key, 0, "".join(r[1:])
+
+def encode_payload(raw, compress=True):
+    # 시트 셀에 넣을 문자열. 압축해서 UTF-8 바이트가 줄어들 때만 압축본 사용
+    if compress and len(raw) >= COMPRESS_MIN:
+        z = COMPRESS_PREFIX + base64.b85encode(zlib.compress(raw.encode("utf-8"), 9)).decode("ascii")
+        if len(z) < len(raw.encode("utf-8")): return z
+    return raw
+
+def decode_payload(text):
+    # 머리표가 있으면 압축 해제, 없으면 예전 평문 JSON 그대로
+    if text.startswith(COMPRESS_PREFIX): return zlib.decompress(base64.b85decode(text[len(COMPRESS_PREFIX):])).decode("utf-8")
+    return text
+
+def to_cells(raw, compress=True):
+    text = encode_payload(raw, compress)
+    return [text[i:i+CHUNK_SIZE] for i in range(0, len(text), CHUNK_SIZE)]
+
+def _runs(rows):
+    # 정렬된 행 번호 → 이어진 구간 [(시작, 끝)]
+    out = []
+    for r in rows:
+        if out and out[-1][1] == r - 1: out[-1][1] = r
+        else: out.append([r, r])
+    return [tuple(x) for x in out]
+
+def _col_letter(n):
+    s = ""
+    while n: n, r = divmod(n - 1, 26); s = chr(65 + r) + s
+    return s
+
+def open_sheet(gcp_info, sheet_id, worksheet=None):
+    # gcp_info: 서비스 계정 JSON 문자열 (secrets의 gcp.info). worksheet: 첫 시트 대신 쓸 워크시트 이름 (없으면 만듦)
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    creds_dict = json.loads(gcp_info, strict=False)
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+    client = gspread.authorize(creds)
+    book = client.open_by_key(sheet_id)
+    if not worksheet: return book.sheet1
+    try: return book.worksheet(worksheet)
+    except gspread.WorksheetNotFound: return book.add_worksheet(title=worksheet, rows=1000, cols=26)
+
+# ==========================================
+# Google Sheets
+# ==========================================
+class RowIndex:
+    """'folder/filename' 키 → 시트 행 번호. 모든 세션이 공유 (SHEET.find 대체)"""
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.lock = threading.RLock()
+        self.rows = {}
+        self.built_at = 0.0
+
+    def rebuild(self, keys=None):
+        if keys is None: keys = self.sheet.col_values(1) # A열 1회 읽기
+        with self.lock:
+            self.rows = {}
+            for i, k in enumerate(keys):
+                if k: self.rows.setdefault(k, i + 1) # find와 동일하게 첫 번째 행 우선
+            self.built_at = time.time()
+
+    def get(self, key, force=False):
+        with self.lock:
+            if force or not self.built_at: self.rebuild()
+            row = self.rows.get(key)
+            # 없는 키: 다른 프로세스/수동 편집 가능성 → 너무 잦지 않게 재구축
+            if row is None and not force and time.time() - self.built_at > INDEX_REBUILD_MIN_SEC:
+                self.rebuild(); row = self.rows.get(key)
+            return row
+
+    def invalidate(self):
+        with self.lock: self.built_at = 0.0
+
+    def assigned(self, key, row):
+        with self.lock: self.rows[key] = row
+
+    def deleted(self, rows):
+        # 행 삭제 이후 아래 행들이 그 위에서 지워진 행 수만큼 올라감
+        gone = sorted(rows)
+        with self.lock:
+            self.rows = {k: r - bisect.bisect_left(gone, r) for k, r in self.rows.items() if r not in rows}
+
+class WriteQueue:
+    """키별로 마지막 값만 남기고(coalesce) 기존 행은 한 번의 batch_update, 새 키는 한 번의 append_rows로 기록. 모든 세션이 공유
+
+    기록 직전에 기존 행들의 버전 열을 한 번에 읽어 기대 버전(base)과 비교 (compare-and-swap).
+    다르면 다른 프로세스가 먼저 쓴 것 → 그 키는 쓰지 않고 on_conflict(key, 실제 버전) 호출"""
+    def __init__(self, sheet, index, on_conflict):
+        self.sheet, self.index, self.on_conflict = sheet, index, on_conflict
+        self.lock = threading.Lock()        # pending/inflight 보호
+        self.flush_lock = threading.RLock() # flush/행 삭제 직렬화 (행 번호 배정 충돌 방지)
+        self.pending, self.inflight = {}, {} # key → (row_data, base)
+        self.batch_max = WRITE_BATCH_MAX
+        self.first_at = 0.0
+        self.last_error, self.failures = None, 0 # 연속 실패 → 자동 flush 간격을 늘림
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def put(self, key, row_data, base):
+        with self.lock:
+            if not self.pending: self.first_at = time.time()
+            if key in self.pending: base = self.pending[key][1] # 합쳐져도 시트에 있는 버전은 그대로
+            self.pending[key] = (row_data, base)
+            full = len(self.pending) >= self.batch_max
+        if full: self.flush()
+
+    def discard(self, key):
+        with self.lock: self.pending.pop(key, None)
+
+    def unflushed(self):
+        # 아직 시트에 없는 행 (스냅샷을 새로 받을 때 덮어씌워 read-your-writes 유지)
+        with self.lock: return {k: v[0] for k, v in {**self.inflight, **self.pending}.items()}
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                self.inflight = batch
+            if not batch: return
+            try:
+                with tracing.span("store.flush", rows=len(batch)): self._write(batch)
+                self.last_error, self.failures = None, 0
+            except Exception as e:
+                # 재시도까지 실패 → 버리지 않고 대기열로 되돌림 (그 사이 들어온 새 값이 우선, base는 예전 것)
+                self.last_error, self.failures = e, self.failures + 1
+                with self.lock:
+                    for k, (row_data, base) in batch.items():
+                        self.pending[k] = (self.pending[k][0], base) if k in self.pending else (row_data, base)
+                    self.first_at = time.time() + min(60, 2 ** self.failures)
+                self.index.invalidate()
+                print(f"Save Error: {e}")
+            finally:
+                with self.lock: self.inflight = {}
+
+    def _check(self, batch, rows):
+        # CAS: 기존 행의 키/버전 열(A:B)을 한 번에 읽어 비교. 버전이 다르면 그 키는 빼고 on_conflict
+        # A열이 다른 키면 색인이 낡은 것(다른 프로세스가 행을 지움) → 한 번 재구축하고 그 키들만 다시 확인
+        todo = [k for k, r in rows.items() if r]
+        if not todo: return
+        for _ in range(2):
+            moved = []
+            for k, vr in zip(todo, self.sheet.batch_get([f"A{rows[k]}:B{rows[k]}" for k in todo])):
+                cells = vr[0] if vr else []
+                if not cells or cells[0] != k: moved.append(k); continue
+                actual = parse_stamp(cells[1] if len(cells) > 1 else "") or 0
+                if actual != batch[k][1]:
+                    del batch[k], rows[k]
+                    self.on_conflict(k, actual)
+            if moved: self.index.rebuild()
+            for k in moved: rows[k] = self.index.get(k)
+            todo = [k for k in moved if rows[k]] # 그 사이 지워진 키는 새 키로 붙임
+            if not todo: return
+        self.index.invalidate()
+        raise StorageError(f"행 위치가 계속 바뀜: {', '.join(todo[:5])}") # flush가 대기열로 되돌려 나중에 재시도
+
+    def _write(self, batch):
+        rows = {key: self.index.get(key) for key in batch}
+        if not all(rows.values()): # 새 키 → 다른 프로세스가 방금 만들었을 수 있어 A열을 새로 읽고 다시 찾음 (있으면 아래 CAS 대상)
+            self.index.rebuild(); rows = {key: self.index.get(key) for key in batch}
+        self._check(batch, rows)
+        if not batch: return
+        need_cols = max(len(row_data) for row_data, _ in batch.values())
+        if need_cols > self.sheet.col_count: self.sheet.resize(cols=need_cols + 5) # 행 수는 건드리지 않음 (다른 프로세스가 늘렸을 수 있음)
+        # 기존 행: 줄어든 행의 옛 조각이 남지 않도록 나머지 칸은 빈 값으로 덮음
+        width = self.sheet.col_count
+        data = [{"range": f"A{rows[key]}", "values": [row_data + [""] * (width - len(row_data))]} for key, (row_data, _) in batch.items() if rows[key]]
+        if data: self.sheet.batch_update(data)
+        # 새 키: 행 번호를 미리 정하면 다른 프로세스가 방금 쓴 행을 덮을 수 있음 → append로 한 번에 붙이고 응답의 범위로 행 번호를 받음
+        new = [key for key in batch if not rows[key]]
+        if new:
+            resp = self.sheet.append_rows([batch[key][0] for key in new])
+            m = re.search(r"![A-Z]+(\d+)", (resp or {}).get("updates", {}).get("updatedRange", ""))
+            if not m: self.index.invalidate(); return # 행 번호를 모름 → 다음 조회 때 재구축
+            for i, key in enumerate(new): self.index.assigned(key, int(m.group(1)) + i)
+
+    def _loop(self):
+        while True:
+            time.sleep(0.5)
+            if self.pending and time.time() - self.first_at > WRITE_FLUSH_SEC: self.flush()
+
+class SheetSnapshot:
+    """시트 내용의 사본. 셀 문자열을 이어 붙여 보관하고 압축 해제는 읽을 때 함"""
+    def __init__(self, rows=()):
+        self.raw, self.ver, self.keys = {}, {}, []
+        for r in rows:
+            key, ver, text = split_row(r)
+            self.keys.append(key)
+            if key and key not in self.raw: self.raw[key], self.ver[key] = text, ver # 중복 키는 첫 행 우선
+        self.fetched_at = time.time()
+
+    def copy(self):
+        c = SheetSnapshot()
+        c.raw, c.ver, c.keys = dict(self.raw), dict(self.ver), list(self.keys)
+        return c
+
+    def get(self, key):
+        text = self.raw.get(key)
+        return decode_payload(text) if text else text
+
+    def version(self, key): return self.ver.get(key, 0)
+
+    def scan(self, prefix):
+        # prefix로 시작하는 키 → 원문. 다른 세션의 put/pop이 raw를 바꾸는 중일 수 있어 사본을 순회
+        return {k: decode_payload(v) for k, v in list(self.raw.items()) if k.startswith(prefix)}
+
+    def put(self, key, raw, ver): self.raw[key], self.ver[key] = raw, ver
+    def pop(self, key): self.raw.pop(key, None); self.ver.pop(key, None)
+
+class SheetsBackend:
+    """시트 하나를 키-값 저장소로. 읽기는 공유 스냅샷 + 버전 열만 보는 증분 동기화, 쓰기는 write-behind 큐"""
+    def __init__(self, sheet, compress=True, limiters=None):
+        self.sheet = ratelimit.LimitedSheet(sheet, limiters or ratelimit.default_limiters())
+        self.compress = compress
+        self.index = RowIndex(self.sheet)
+        self.queue = WriteQueue(self.sheet, self.index, self._on_conflict)
+        self.lock = threading.Lock()   # 스냅샷 갱신
+        self.vlock = threading.Lock()  # versions / conflicts
+        self.versions = {}  # key → 이 프로세스가 아는 최신 버전 (대기 중인 쓰기 포함)
+        self.conflicts = {} # key → 충돌 시각
+        self.snap, self.stale = None, False
+
+    def view(self):
+        # 세션 간 공유되는 최신 스냅샷. 처음엔 전체를 받고, 이후엔 TTL 만료/invalidate() 때 증분 동기화
+        with self.lock:
+            if self.snap is None: self._load_all()
+            elif self.stale or time.time() - self.snap.fetched_at > SNAPSHOT_TTL: self._sync()
+            return self.snap
+
+    def _load_all(self):
+        with tracing.span("store.load_all") as sp:
+            snap = SheetSnapshot(self.sheet.get_all_values())
+            sp.set(rows=len(snap.keys))
+        self.index.rebuild(snap.keys) # A열을 따로 읽을 필요 없음
+        self._adopt(snap)
+
+    def _sync(self):
+        # A:B(키 + 버전)만 읽고, 버전이 바뀌었거나 새로 생긴 행만 다시 받음
+        snap, pending = self.snap.copy(), self.queue.unflushed()
+        keys, seen, changed = [], set(), []
+        for i, r in enumerate(self.sheet.get("A:B")):
+            key = r[0] if r else ""
+            keys.append(key)
+            if not key or key in seen: continue
+            seen.add(key)
+            if key in pending: continue
+            b = r[1] if len(r) > 1 else ""
+            ver = parse_stamp(b)
+            if ver is not None: same = key in snap.raw and snap.ver.get(key) == ver
+            else: same = key in snap.raw and not snap.ver.get(key) and snap.raw[key].startswith(b) # 버전 없는 예전 행은 첫 조각으로 비교
+            if not same: changed.append(i + 1)
+        for key in [k for k in snap.raw if k not in seen and k not in pending]: snap.pop(key)
+        with tracing.span("store.sync", rows=len(changed)):
+            for i in range(0, len(changed), 100):
+                for vr in self.sheet.batch_get([f"{n}:{n}" for n in changed[i:i+100]]):
+                    key, ver, text = split_row(vr[0] if vr else [])
+                    if key: snap.put(key, text, ver)
+        snap.keys = keys
+        self.index.rebuild(keys)
+        self._adopt(snap)
+
+    def _adopt(self, snap):
+        # 아직 시트에 안 간 값을 덮어씌우고, 외부에서 바뀐 키의 버전을 받아들임
+        for k, row_data in self.queue.unflushed().items():
+            key, ver, text = split_row(row_data)
+            snap.put(key, text, ver)
+        with self.vlock:
+            for k, v in snap.ver.items():
+                if v > self.versions.get(k, -1): self.versions[k] = v
+        snap.fetched_at = time.time()
+        self.snap, self.stale = snap, False
+
+    def _on_conflict(self, key, actual):
+        with self.vlock:
+            self.versions[key] = actual
+            now = self.conflicts[key] = time.time()
+            for k in [k for k, t in self.conflicts.items() if now - t > 3600]: del self.conflicts[k]
+        snap = self.snap
+        if snap is not None: snap.pop(key) # 다음 동기화에서 상대가 쓴 값을 다시 받음
+        self.stale = True
+        print(f"Version Conflict: {key} (시트 v{actual})")
+
+    def conflicts_since(self, ts):
+        with self.vlock: return [k for k, t in self.conflicts.items() if t >= ts]
+
+    def load_index(self):
+        # A:B(키 + 버전)만 읽어 행 번호와 버전을 맞춤. 값이 필요 없을 때(가져오기) 전체 스냅샷 대신
+        keys, vers = [], {}
+        for r in self.sheet.get("A:B"):
+            key = r[0] if r else ""
+            keys.append(key)
+            if key and key not in vers: vers[key] = (parse_stamp(r[1]) if len(r) > 1 else None) or 0
+        self.index.rebuild(keys)
+        with self.vlock:
+            for k, v in vers.items(): self.versions[k] = max(v, self.versions.get(k, 0))
+
+    def stream(self, page_rows=EXPORT_PAGE_ROWS):
+        # 시트를 page_rows행씩 읽으며 (key, raw). 전체를 메모리에 올리지 않음 (중복 키는 첫 행 우선)
+        last_col, seen = _col_letter(self.sheet.col_count), set()
+        for start in range(1, self.sheet.row_count + 1, page_rows):
+            with tracing.span("store.export_page", rows=page_rows):
+                rows = self.sheet.get(f"A{start}:{last_col}{start + page_rows - 1}")
+            for r in rows:
+                key, _, text = split_row(r)
+                if key and text and key not in seen:
+                    seen.add(key); yield key, decode_payload(text)
+
+    def get(self, key): return self.view().get(key)
+    def scan(self, prefix): return self.view().scan(prefix)
+    def version(self, key):
+        with self.vlock: return self.versions.get(key, 0)
+
+    def fetch(self, keys):
+        # 몇 키만 필요할 때 전체 스냅샷(view) 대신: 대기 쓰기 → 색인의 행 번호로 그 행들만 batch_get. 행의 키가 다르면 재구축 후 한 번 더
+        if self.snap is not None: return {k: v for k, v in ((k, self.view().get(k)) for k in keys) if v}
+        pending, out = self.queue.unflushed(), {}
+        for k in keys:
+            if k in pending: out[k] = split_row(pending[k])[2]
+        todo = [k for k in keys if k not in out]
+        for attempt in range(2):
+            if attempt: self.index.rebuild()
+            found = [(k, r) for k, r in ((k, self.index.get(k)) for k in todo) if r]
+            todo = []
+            for i in range(0, len(found), 100):
+                part = found[i:i + 100]
+                with tracing.span("store.fetch", rows=len(part)):
+                    for (k, _), vr in zip(part, self.sheet.batch_get([f"{r}:{r}" for _, r in part])):
+                        key, _, text = split_row(vr[0] if vr else [])
+                        if key != k: todo.append(k)
+                        elif text: out[k] = text
+            if not todo: break
+        return {k: decode_payload(text) for k, text in out.items()}
+
+    def put(self, key, raw, view=None, expect=None):
+        with self.vlock:
+            cur = self.versions.get(key, 0)
+            if expect is not None and expect != cur: raise VersionConflict(f"{key}: v{expect}을 읽었지만 현재 v{cur}")
+            new = self.versions[key] = cur + 1
+        if view is not None: view.put(key, raw, new)
+        if self.snap is not None and self.snap is not view: self.snap.put(key, raw, new)
+        self.queue.put(key, [key, make_stamp(new)] + to_cells(raw, self.compress), cur) # 실제 기록은 flush 때
+        return new
+
+    def delete(self, key, view=None): return self.delete_many([key], view) > 0
+
+    def delete_many(self, keys, view=None):
+        # 여러 키의 행을 한 요청으로 지움 (이어진 행은 한 구간, 아래 구간부터) → 지운 행 수
+        keys = list(keys)
+        for key in keys:
+            if view is not None: view.pop(key)
+            if self.snap is not None and self.snap is not view: self.snap.pop(key)
+            self.queue.discard(key)
+        with self.vlock:
+            for key in keys: self.versions.pop(key, None)
+        # 삭제로 아래 행 번호가 밀리는 동안 다른 flush(다른 세션/_loop)가 옛 번호로 쓰지 않도록 잠금 안에서
+        with self.queue.flush_lock:
+            self.queue.flush() # 행 번호가 밀리기 전에 대기 쓰기부터 반영
+            try:
+                rows = self._rows_of(keys)
+                if rows:
+                    self.sheet.delete_row_ranges(_runs(rows)); self.index.deleted(rows)
+                return len(rows)
+            except:
+                self.index.invalidate(); raise
+
+    def _rows_of(self, keys):
+        # 키들의 지금 행 번호. 색인이 오래됐을 수 있음(외부 편집) → A열이 정말 그 키인지 한 번에 확인, 다르면 재구축 후 다시
+        for attempt in range(2):
+            if attempt: self.index.rebuild()
+            rows = {k: self.index.get(k) for k in keys}
+            rows = {k: r for k, r in rows.items() if r}
+            if not rows: return []
+            ok = [r for (k, r), vr in zip(rows.items(), self.sheet.batch_get([f"A{r}" for r in rows.values()])) if vr and vr[0] and vr[0][0] == k]
+            if len(ok) == len(rows): break
+        return sorted(ok)
+
+    def flush(self): self.queue.flush()
+
+    @property
+    def last_error(self): return self.queue.last_error # 아직 반영 못 한 쓰기가 있으면 그 원인
+
+    def invalidate(self): self.stale = True
+
+    def items(self):
+        snap = self.view()
+        return [(k, snap.get(k)) for k in list(snap.raw)]
+
+    def reencode(self, log=print):
+        # 버전 열이 없거나 저장 형식이 현재 설정(self.compress)과 다른 행만 다시 씀 → batch_update로 묶여 나감
+        snap, n = self.view(), 0
+        for key, text in list(snap.raw.items()):
+            if not text: continue
+            raw = decode_payload(text)
+            if not snap.version(key) or encode_payload(raw, self.compress) != text: self.put(key, raw); n += 1
+        self.flush()
+        log(f"reencoded: {n} rows")
+        return n
+
+# ==========================================
+# SQLite
+# ==========================================
+class SQLiteBackend:
+    """로컬 SQLite (WAL). 키는 PRIMARY KEY라 prefix 조회도 인덱스 범위 검색"""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local() # 스레드별 연결
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL, version INTEGER NOT NULL DEFAULT 0)")
+        try: conn.execute("ALTER TABLE kv ADD COLUMN version INTEGER NOT NULL DEFAULT 0") # 버전 열 없던 예전 DB
+        except sqlite3.OperationalError: pass
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if os.path.dirname(self.path): os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def view(self): return self # 읽기가 충분히 빨라 스냅샷 불필요
+
+    def get(self, key):
+        r = self._conn().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return r[0] if r else None
+
+    def scan(self, prefix):
+        # key >= prefix AND key < (prefix의 마지막 글자 +1) → PK 인덱스 범위 검색
+        hi = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return dict(self._conn().execute("SELECT key, value FROM kv WHERE key >= ? AND key < ?", (prefix, hi)))
+
+    def version(self, key):
+        r = self._conn().execute("SELECT version FROM kv WHERE key = ?", (key,)).fetchone()
+        return r[0] if r else 0
+
+    def fetch(self, keys):
+        keys, out = list(keys), {}
+        for i in range(0, len(keys), 500): # SQLite 변수 개수 한도 아래로
+            part = keys[i:i + 500]
+            out.update(self._conn().execute(f"SELECT key, value FROM kv WHERE key IN ({','.join('?' * len(part))})", part))
+        return out
+
+    def put(self, key, raw, view=None, expect=None):
+        # 버전 확인과 쓰기를 한 트랜잭션에서 (BEGIN IMMEDIATE로 다른 쓰기를 막음)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            r = conn.execute("SELECT version FROM kv WHERE key = ?", (key,)).fetchone()
+            cur = r[0] if r else 0
+            if expect is not None and expect != cur: raise VersionConflict(f"{key}: v{expect}을 읽었지만 현재 v{cur}")
+            conn.execute("INSERT INTO kv (key, value, updated_at, version) VALUES (?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at, version = excluded.version", (key, raw, time.time(), cur + 1))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK"); raise
+        return cur + 1
+
+    def delete(self, key, view=None): return self.delete_many([key]) > 0
+
+    def delete_many(self, keys, view=None):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            n = sum(conn.execute("DELETE FROM kv WHERE key = ?", (key,)).rowcount for key in keys)
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK"); raise
+        return n
+
+    def flush(self): pass
+    def invalidate(self): pass
+    last_error = None # 쓰기는 즉시 실패를 raise
+    def conflicts_since(self, ts): return [] # 충돌은 put에서 바로 VersionConflict
+
+    def items(self): return self._conn().execute("SELECT key, value FROM kv ORDER BY key").fetchall()
+    def stream(self, page_rows=None): yield from self._conn().execute("SELECT key, value FROM kv ORDER BY key") # 커서가 조금씩 읽음
+
+# ==========================================
+# 선택 / 마이그레이션
+# ==========================================
+def open_backend(secrets, kind=None, db_path=None, limiters=None, worksheet=None):
+    # secrets: st.secrets 또는 .streamlit/secrets.toml 내용. general.STORAGE = "sheets" | "sqlite"
+    # worksheet: 시트일 때 첫 시트 대신 쓸 워크시트 (SQLite는 키 prefix로 충분해 무시)
+    general = secrets["general"]
+    kind = kind or general.get("STORAGE", "sheets")
+    if kind == "sqlite": return SQLiteBackend(db_path or general.get("SQLITE_PATH", "chat.db"))
+    if kind == "sheets": return SheetsBackend(open_sheet(secrets["gcp"]["info"], general["SHEET_ID"], worksheet), general.get("COMPRESS_ROWS", True), limiters or ratelimit.default_limiters(general))
+    raise ValueError(f"알 수 없는 저장소: {kind}")
+
+def migrate(src, dst, log=print):
+    # src의 모든 키를 dst로 복사 (덮어쓰기). 시트 쪽 쓰기는 WRITE_BATCH_MAX개씩 batch_update
+    start, n = time.time(), 0
+    if isinstance(dst, SheetsBackend): dst.load_index() # 이미 있는 키의 버전 (모르면 base 0으로 CAS 충돌 → 버려짐)
+    for key, raw in src.stream():
+        if not key or not raw: continue
+        dst.put(key, raw); n += 1
+        if n % 100 == 0: log(f"{n} keys...")
+    dst.flush()
+    if dst.last_error: raise StorageError(f"쓰기 실패: {dst.last_error}")
+    lost = dst.conflicts_since(start)
+    if lost: raise StorageError(f"{len(lost)}/{n}개 키가 버전 충돌로 기록되지 않음 (다른 곳에서 쓰는 중?): {', '.join(lost[:5])}")
+    log(f"done: {n} keys")
+    return n
+
+def move_prefix(src, dst, prefix, log=print):
+    # prefix로 시작하는 키를 src에서 dst로 옮김. dst에 모두 반영된 것을 확인한 뒤에 src에서 지움
+    start, keys = time.time(), []
+    if isinstance(dst, SheetsBackend): dst.load_index()
+    for key, raw in src.stream():
+        if key.startswith(prefix) and raw: dst.put(key, raw); keys.append(key)
+    dst.flush()
+    if dst.last_error: raise StorageError(f"쓰기 실패 (원본은 그대로): {dst.last_error}")
+    lost = dst.conflicts_since(start)
+    if lost: raise StorageError(f"{len(lost)}개 키가 버전 충돌로 기록되지 않음 (원본은 그대로): {', '.join(lost[:5])}")
+    for i in range(0, len(keys), IMPORT_BATCH):
+        src.delete_many(keys[i:i + IMPORT_BATCH])
+        if i + IMPORT_BATCH < len(keys): log(f"{i + IMPORT_BATCH}/{len(keys)} removed...")
+    log(f"moved: {len(keys)} keys")
+    return len(keys)
+
+def _open_text(path, mode, gz):
+    return gzip.open(path, mode + "t", encoding="utf-8") if gz else open(path, mode, encoding="utf-8")
+
+def export_jsonl(src, path, log=print):
+    # 한 줄에 키 하나: {"key": "folder/filename", "value": <JSON>} (JSON이 아닌 값은 "raw": 원문)
+    # .part에 쓰고 끝나면 이름을 바꿈 → 중간에 끊겨도 이전 백업을 덮지 않음
+    n, tmp = 0, path + ".part"
+    with _open_text(tmp, "w", path.endswith(".gz")) as f:
+        for key, raw in src.stream():
+            try: rec = {"key": key, "value": json.loads(raw)}
+            except ValueError: rec = {"key": key, "raw": raw}
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n"); n += 1
+            if n % 1000 == 0: log(f"{n} keys...")
+    os.replace(tmp, path)
+    log(f"exported: {n} keys → {path}")
+    return n
+
+def import_jsonl(dst, path, batch=IMPORT_BATCH, restart=False, log=print):
+    # export_jsonl 파일을 dst에 덮어씀. batch개마다 flush하고 반영된 줄 수를 {path}.ckpt에 기록
+    ckpt, done, start = path + ".ckpt", 0, time.time()
+    if not restart and os.path.exists(ckpt):
+        with open(ckpt) as f: done = int(f.read().strip() or 0)
+        log(f"resuming after line {done}")
+    if isinstance(dst, SheetsBackend):
+        dst.queue.batch_max = batch
+        dst.load_index() # 기존 행 번호/버전만 (CAS 기준)
+
+    saved = [done]
+    def commit(upto):
+        dst.flush()
+        if dst.last_error: raise StorageError(f"쓰기 실패, {saved[0]}번째 줄까지 반영됨 (다시 실행하면 이어서): {dst.last_error}")
+        with open(ckpt, "w") as f: f.write(str(upto))
+        saved[0] = upto
+
+    n, line_no = 0, done
+    with _open_text(path, "r", path.endswith(".gz")) as f:
+        for line_no, line in enumerate(f, 1):
+            if line_no <= done or not line.strip(): continue
+            rec = json.loads(line)
+            dst.put(rec["key"], rec["raw"] if "raw" in rec else json.dumps(rec["value"], ensure_ascii=False)); n += 1
+            if n % batch == 0:
+                commit(line_no); log(f"{line_no} lines...")
+    commit(line_no)
+    lost = dst.conflicts_since(start)
+    if lost: raise StorageError(f"{len(lost)}/{n}개 키가 버전 충돌로 기록되지 않음 (다른 곳에서 쓰는 중? 멈춘 뒤 --restart로 다시): {', '.join(lost[:5])}")
+    os.remove(ckpt)
+    log(f"imported: {n} keys")
+    return n
+
+if __name__ == "__main__":
+    import argparse
+    import tomllib
+    ap = argparse.ArgumentParser(description="저장소 간 데이터 복사")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    mp = sub.add_parser("migrate")
+    mp.add_argument("src", choices=["sheets", "sqlite"])
+    mp.add_argument("dst", choices=["sheets", "sqlite"])
+    mp.add_argument("--db", help="SQLite 파일 (기본: secrets의 SQLITE_PATH 또는 chat.db)")
+    mp.add_argument("--secrets", default=".streamlit/secrets.toml")
+    rp = sub.add_parser("reencode", help="시트의 기존 행을 현재 압축 설정으로 다시 씀")
+    rp.add_argument("--plain", action="store_true", help="압축을 풀어 평문 JSON으로")
+    rp.add_argument("--secrets", default=".streamlit/secrets.toml")
+    vp = sub.add_parser("move", help="prefix로 시작하는 키를 시트의 다른 워크시트로 옮김")
+    vp.add_argument("prefix")
+    vp.add_argument("--worksheet", required=True)
+    vp.add_argument("--secrets", default=".streamlit/secrets.toml")
+    ep = sub.add_parser("export", help="전체를 JSONL로 백업 (.gz면 gzip)")
+    ep.add_argument("path")
+    ep.add_argument("--from", dest="src", choices=["sheets", "sqlite"], help="기본: secrets의 STORAGE")
+    ep.add_argument("--db"); ep.add_argument("--secrets", default=".streamlit/secrets.toml")
+    ip = sub.add_parser("import", help="JSONL 백업을 복원 (같은 키는 덮어씀, 끊기면 이어서)")
+    ip.add_argument("path")
+    ip.add_argument("--to", dest="dst", choices=["sheets", "sqlite"], help="기본: secrets의 STORAGE")
+    ip.add_argument("--batch", type=int, default=IMPORT_BATCH, help="batch_update 한 번에 쓸 키 수")
+    ip.add_argument("--restart", action="store_true", help="체크포인트를 무시하고 처음부터")
+    ip.add_argument("--db"); ip.add_argument("--secrets", default=".streamlit/secrets.toml")
+    args = ap.parse_args()
+    with open(args.secrets, "rb") as f: secrets = tomllib.load(f)
+    if args.cmd == "reencode":
+        sb = open_backend(secrets, "sheets")
+        sb.compress = not args.plain
+        sb.reencode()
+    elif args.cmd == "move":
+        lim = ratelimit.default_limiters(secrets["general"]) # 같은 스프레드시트 → 쿼터 공유
+        move_prefix(open_backend(secrets, "sheets", limiters=lim), open_backend(secrets, "sheets", limiters=lim, worksheet=args.worksheet), args.prefix)
+    elif args.cmd == "export":
+        export_jsonl(open_backend(secrets, args.src, args.db), args.path)
+    elif args.cmd == "import":
+        import_jsonl(open_backend(secrets, args.dst, args.db), args.path, args.batch, args.restart)
+    else:
+        if args.src == args.dst: sys.exit("src와 dst가 같습니다")
+        migrate(open_backend(secrets, args.src, args.db), open_backend(secrets, args.dst, args.db))
@@ -0,0 +1,144 @@
+"""
+가벼운 호출 추적. 저장소/LLM 호출마다 span(시간, 바이트, 조각 수, 토큰 수)을 남기고
+리런 단위로 모아 세션별로 누적. TRACE_FILE을 주면 끝난 리런마다 JSONL 한 줄.
+
+  run = start(session)      이번 리런 시작 (contextvars로 현재 스레드에 묶임)
+  with span("name", k=v) as sp: ... sp.set(bytes=n) / sp.add(chunks=1)
+  sp = begin("name"); ...; sp.end()   스트리밍처럼 with로 감싸기 어려운 경우
+  finish(run)               집계 → 세션 누적 + JSONL. 여러 번 불러도 한 번만 반영
+  bind(fn)                  스레드풀에 넘길 때 현재 리런을 같이 넘김 (submit마다 따로)
+  scope(session, kind)      백그라운드 작업을 별도 실행 단위로 (예: 요약)
+
+실행 단위 밖(백그라운드 flush 등)의 span은 기록하지 않음.
+"""
+import json
+import time
+import uuid
+import threading
+import functools
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+MAX_SPANS = 1000    # 실행 단위당 보관할 span 수 (넘으면 세기만 함)
+MAX_SESSIONS = 200  # 누적을 보관할 세션 수
+COUNTERS = ("bytes", "chunks", "rows", "tokens", "tokens_in", "tokens_out")
+
+_current = contextvars.ContextVar("tracing_run", default=None)
+_sink = {"path": None, "lock": threading.Lock()}
+_sessions = OrderedDict()
+_slock = threading.Lock()
+
+class Span:
+    __slots__ = ("run", "name", "t0", "at", "ms", "attrs")
+    def __init__(self, run, name, attrs):
+        self.run, self.name, self.attrs = run, name, attrs
+        self.t0, self.ms = time.perf_counter(), None
+        self.at = (self.t0 - run.t0) * 1000 if run else 0.0 # 실행 시작부터 ms
+
+    def set(self, **kw): self.attrs.update(kw)
+
+    def add(self, **kw):
+        for k, v in kw.items(): self.attrs[k] = self.attrs.get(k, 0) + v
+
+    def end(self):
+        if self.ms is not None: return
+        self.ms = (time.perf_counter() - self.t0) * 1000
+        if self.run is not None: self.run.record(self)
+
+    def to_dict(self): return {"name": self.name, "at": round(self.at, 1), "ms": round(self.ms, 1), **self.attrs}
+
+class Run:
+    def __init__(self, session, kind):
+        self.id, self.session, self.kind = uuid.uuid4().hex[:12], session, kind
+        self.ts, self.t0, self.ms = time.time(), time.perf_counter(), None
+        self.spans, self.dropped = [], 0
+        self.lock = threading.Lock()
+
+    def record(self, sp):
+        with self.lock:
+            if self.ms is not None: return # 끝난 뒤에 닫힌 span (버려진 스트림, 늦은 헤징 요청)
+            if len(self.spans) < MAX_SPANS: self.spans.append(sp)
+            else: self.dropped += 1
+
+    def totals(self):
+        # 이름별 {"n", "ms", "max_ms", "errors", 카운터...}
+        out = {}
+        for sp in self.spans:
+            t = out.setdefault(sp.name, {"n": 0, "ms": 0.0, "max_ms": 0.0, "errors": 0})
+            t["n"] += 1; t["ms"] += sp.ms; t["max_ms"] = max(t["max_ms"], sp.ms)
+            if "error" in sp.attrs: t["errors"] += 1
+            for k in COUNTERS:
+                if isinstance(sp.attrs.get(k), (int, float)): t[k] = t.get(k, 0) + sp.attrs[k]
+        return out
+
+def size_of(x):
+    # 주고받은 값의 대략적인 크기 (UTF-8 바이트). 시트 응답처럼 중첩된 목록/딕셔너리도
+    if isinstance(x, str): return len(x.encode("utf-8"))
+    if isinstance(x, (bytes, bytearray)): return len(x)
+    if isinstance(x, dict): return sum(size_of(v) for v in x.values())
+    if isinstance(x, (list, tuple)): return sum(size_of(v) for v in x)
+    return 0
+
+def configure(path): _sink["path"] = path or None
+
+def current(): return _current.get()
+
+def start(session, kind="rerun"):
+    run = Run(session, kind)
+    _current.set(run)
+    return run
+
+def begin(name, **attrs): return Span(_current.get(), name, attrs)
+
+@contextmanager
+def span(name, **attrs):
+    sp = begin(name, **attrs)
+    try: yield sp
+    except Exception as e:
+        sp.set(error=type(e).__name__); raise
+    finally: sp.end()
+
+def bind(fn):
+    return functools.partial(contextvars.copy_context().run, fn)
+
+@contextmanager
+def scope(session, kind):
+    token = _current.set(Run(session, kind))
+    try: yield _current.get()
+    finally:
+        finish(_current.get()); _current.reset(token)
+
+def _merge(dst, totals):
+    for name, t in totals.items():
+        d = dst.setdefault(name, {"n": 0, "ms": 0.0, "max_ms": 0.0, "errors": 0})
+        for k, v in t.items(): d[k] = max(d.get(k, 0), v) if k == "max_ms" else d.get(k, 0) + v
+
+def finish(run):
+    """실행 단위를 닫고 이름별 집계를 돌려줌 (이미 닫혔으면 None)"""
+    if run is None: return None
+    with run.lock:
+        if run.ms is not None: return None
+        run.ms = (time.perf_counter() - run.t0) * 1000
+    totals = run.totals()
+    with _slock:
+        s = _sessions.pop(run.session, None) or {"runs": {}, "ms": {}, "spans": {}, "last": None}
+        s["runs"][run.kind] = s["runs"].get(run.kind, 0) + 1
+        s["ms"][run.kind] = s["ms"].get(run.kind, 0.0) + run.ms
+        _merge(s["spans"], totals)
+        if run.kind == "rerun": s["last"] = {"ms": run.ms, "spans": totals, "dropped": run.dropped}
+        _sessions[run.session] = s
+        while len(_sessions) > MAX_SESSIONS: _sessions.popitem(last=False)
+    if _sink["path"]:
+        rec = {"ts": round(run.ts, 3), "session": run.session, "run": run.id, "kind": run.kind, "ms": round(run.ms, 1),
+               "dropped": run.dropped, "totals": totals, "spans": [sp.to_dict() for sp in run.spans]}
+        try:
+            with _sink["lock"], open(_sink["path"], "a", encoding="utf-8") as f: f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+        except OSError as e: print(f"Trace Write Error: {e}")
+    return totals
+
+def session_stats(session):
+    # {"runs": {kind: n}, "ms": {kind: 합}, "spans": 이름별 누적, "last": 마지막으로 끝난 리런}
+    with _slock:
+        s = _sessions.get(session)
+        return json.loads(json.dumps(s)) if s else None